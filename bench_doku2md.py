@@ -0,0 +1,421 @@
+#!/usr/bin/env python3
+
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from multiprocessing import get_context
+
+import doku2md
+from doku2md import DokuWiki2MarkDown
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+PAGE_KINDS = ('mixed', 'tables', 'lists', 'code')
+PAGE_SIZES = {'tiny': 1 << 10, 'medium': 64 << 10, 'large': 2 << 20}
+
+WORDS = ('wiki', 'page', 'syntax', 'namespace', 'convert', 'markdown', 'server', 'backup', 'user', 'config',
+         'release', 'network', 'install', 'the', 'a', 'of', 'and', 'to', 'with', 'for', 'is', 'on', 'data')
+
+
+# Synthetic corpus ------------------------------------------------------------
+
+def _words(rng, n):
+    return ' '.join(rng.choice(WORDS) for _ in range(n))
+
+
+def _inline(rng):
+    """A fragment of running text, sometimes with inline markup."""
+    roll = rng.random()
+    if roll < 0.70:
+        return _words(rng, rng.randint(3, 12))
+    markup = rng.choice((
+        lambda: f'//{_words(rng, 2)}//',
+        lambda: f'__{_words(rng, 2)}__',
+        lambda: f'**{_words(rng, 2)}**',
+        lambda: f"''{_words(rng, 1)}''",
+        lambda: f'<del>{_words(rng, 2)}</del>',
+        lambda: f'[[{_words(rng, 1)}:{_words(rng, 1)}:{rng.choice(WORDS)}|{_words(rng, 2)}]]',
+        lambda: f'[[https://example.com/{rng.choice(WORDS)}/{rng.randint(1, 999)}]]',
+        lambda: f'{{{{{rng.choice(WORDS)}:{rng.choice(WORDS)}.png?{rng.randint(16, 400)}}}}}',
+        lambda: f'(({_words(rng, 5)}))',
+    ))
+    return markup()
+
+
+def _paragraph(rng):
+    lines = []
+    for _ in range(rng.randint(1, 5)):
+        line = ' '.join(_inline(rng) for _ in range(rng.randint(1, 6)))
+        lines.append(line + (' \\\\' if rng.random() < 0.1 else ''))
+    return '\n'.join(lines)
+
+
+def _header(rng):
+    marks = '=' * rng.randint(2, 6)
+    return f'{marks} {_words(rng, rng.randint(1, 5)).title()} {marks}'
+
+
+def _list(rng):
+    lines = []
+    bullet = rng.choice('*-')
+    depth = 1
+    for _ in range(rng.randint(2, 15)):
+        depth = max(1, min(4, depth + rng.choice((-1, 0, 0, 1))))
+        lines.append('  ' * depth + f'{bullet} {_inline(rng)}')
+    return '\n'.join(lines)
+
+
+def _table(rng):
+    columns = rng.randint(2, 6)
+    rows = ['^ ' + ' ^ '.join(_words(rng, 2) for _ in range(columns)) + ' ^']
+    for _ in range(rng.randint(2, 40)):
+        cells = [_inline(rng) if rng.random() < 0.3 else _words(rng, rng.randint(1, 3)) for _ in range(columns)]
+        if rng.random() < 0.05:
+            cells[-1] = ''  # colspan
+        if rng.random() < 0.05:
+            cells[0] = ':::'  # rowspan
+        rows.append('| ' + ' | '.join(cells) + ' |')
+    return '\n'.join(rows)
+
+
+def _code(rng):
+    tag = rng.choice(('code', 'file'))
+    lang = rng.choice(('', ' bash', ' python', ' php myexample.php'))
+    body = '\n'.join(f'{"    " * rng.randint(0, 3)}{_words(rng, rng.randint(1, 8))} // {rng.randint(0, 99)}'
+                     for _ in range(rng.randint(2, 30)))
+    return f'<{tag}{lang}>\n{body}\n</{tag}>'
+
+
+BLOCKS = {'paragraph': _paragraph, 'header': _header, 'list': _list, 'table': _table, 'code': _code}
+# Relative weight of each block type per page kind
+KIND_WEIGHTS = {
+    'mixed': {'paragraph': 4, 'header': 1, 'list': 2, 'table': 1, 'code': 1},
+    'tables': {'paragraph': 1, 'header': 1, 'list': 0, 'table': 8, 'code': 0},
+    'lists': {'paragraph': 1, 'header': 1, 'list': 8, 'table': 0, 'code': 0},
+    'code': {'paragraph': 1, 'header': 1, 'list': 0, 'table': 0, 'code': 8},
+}
+
+
+def generate_page(seed, kind='mixed', size=PAGE_SIZES['tiny']):
+    """Return a reproducible DokuWiki page of about size characters made of blocks typical of kind."""
+    rng = random.Random(f'{seed}:{kind}:{size}')
+    names = list(KIND_WEIGHTS[kind])
+    weights = [KIND_WEIGHTS[kind][name] for name in names]
+    blocks = [_header(rng)]
+    length = len(blocks[0])
+    while length < size:
+        block = BLOCKS[rng.choices(names, weights)[0]](rng)
+        blocks.append(block)
+        length += len(block) + 2
+    return '\n\n'.join(blocks) + '\n'
+
+
+def generate_tree(root, seed, pages=500, depth=6, fanout=3):
+    """Write a reproducible namespace tree of DokuWiki pages below root.
+
+    Page sizes follow a long tail (mostly tiny pages, a few medium and large ones) and
+    namespaces nest up to depth levels. Returns (number of pages, total size in bytes).
+    """
+    rng = random.Random(seed)
+    namespaces, level = [''], ['']
+    for n in range(depth):
+        level = [os.path.join(ns, f'ns{n}_{i}') for ns in level for i in range(fanout)]
+        namespaces += level
+    total = 0
+    for n in range(pages):
+        size = rng.choices(list(PAGE_SIZES.values()), (90, 9, 1))[0]
+        text = generate_page(f'{seed}:{n}', rng.choice(PAGE_KINDS), rng.randint(size // 2, size))
+        directory = os.path.join(root, rng.choice(namespaces))
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f'page{n}.txt'), 'w') as f:
+            f.write(text)
+        total += len(text.encode())
+    return pages, total
+
+
+# Timing ----------------------------------------------------------------------
+
+def load_converter(path):
+    """Load the DokuWiki2MarkDown class from another copy of doku2md.py (eg. an older revision)."""
+    spec = importlib.util.spec_from_file_location('doku2md_baseline', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.DokuWiki2MarkDown
+
+
+def transform_inputs(converter, text):
+    """Return (name, input) for every regex engine transform, fed what it sees in a real conversion."""
+    stages = [('_rm_timestamp', text)]
+    text = converter._rm_timestamp(text)
+    stages.append(('_extract_codeblocks', text))
+    codeblocks, text = converter._extract_codeblocks(text, None)
+    for name in DokuWiki2MarkDown._TRANSFORMS:
+        stages.append((name, text))
+        text = getattr(converter, name)(text)
+    stages.append(('_restore_codeblocks', text))
+    return stages, codeblocks
+
+
+def time_call(func, repeat, min_time=0.05):
+    """Best time of repeat runs of func, each run calling it enough times to last min_time."""
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed else 10
+    best = elapsed / number
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        best = min(best, (time.perf_counter() - start) / number)
+    return best
+
+
+def bench_transforms(converter, text, repeat, min_time=0.05):
+    """Seconds per call of each transform of converter on text."""
+    stages, codeblocks = transform_inputs(converter, text)
+    timings = {}
+    for name, stage_input in stages:
+        if name == '_extract_codeblocks':
+            func = (lambda t=stage_input: converter._extract_codeblocks(t, None))
+        elif name == '_restore_codeblocks':
+            func = (lambda t=stage_input: converter._restore_codeblocks(t, codeblocks))
+        else:
+            func = (lambda f=getattr(converter, name), t=stage_input: f(t))
+        timings[name] = time_call(func, repeat, min_time)
+    timings['_dokuwiki_to_markdown'] = time_call(lambda: converter._dokuwiki_to_markdown(text, None, False),
+                                                 repeat, min_time)
+    return timings
+
+
+def peak_rss_kb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if platform.system() == 'Darwin' else rss  # bytes on macOS, KiB elsewhere
+
+
+def _throughput(seconds, pages, size):
+    return {'seconds': seconds, 'pages_per_s': pages / seconds, 'mb_per_s': size / seconds / 1e6}
+
+
+def bench_page(seed, kind, size_name, repeat, min_time):
+    """Benchmark the conversion of one synthetic page (run in a fresh process to isolate its peak RSS)."""
+    text = generate_page(seed, kind, PAGE_SIZES[size_name])
+    size = len(text.encode())
+    result = {'kind': kind, 'size': size_name, 'bytes': size, 'engines': {}}
+    for engine in doku2md.ENGINES:
+        seconds = time_call(lambda: DokuWiki2MarkDown._dokuwiki_to_markdown(text, None, False, engine), repeat, min_time)
+        result['engines'][engine] = _throughput(seconds, 1, size)
+    result['transforms_us'] = {name: seconds * 1e6 for name, seconds in
+                               bench_transforms(DokuWiki2MarkDown, text, repeat, min_time).items()}
+    result['peak_rss_kb'] = peak_rss_kb()
+    return result
+
+
+def bench_directory(tree, engine, jobs):
+    """Convert a whole tree with convert_directory (run in a fresh process to isolate its peak RSS)."""
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        DokuWiki2MarkDown.convert_directory(tree, None, False, jobs, engine=engine)
+    seconds = time.perf_counter() - start
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss if resource else None
+    return seconds, peak_rss_kb(), children
+
+
+def _isolated(func, *args):
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+        return executor.submit(func, *args).result()
+
+
+def run_suite(seed, pages, jobs, repeat, min_time, sizes=tuple(PAGE_SIZES), log=print):
+    """Run the whole benchmark suite and return its results as a JSON-serialisable dict."""
+    results = {
+        'converter': doku2md.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'seed': seed,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'pages': [],
+        'directory': [],
+    }
+    for kind in PAGE_KINDS:
+        for size_name in sizes:
+            log(f'page {kind}/{size_name}')
+            results['pages'].append(_isolated(bench_page, seed, kind, size_name, repeat, min_time))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        count, size = generate_tree(tmp, seed, pages)
+        for engine in doku2md.ENGINES:
+            for n in sorted({1, jobs}):
+                log(f'directory {engine} -j {n}')
+                seconds, rss, children_rss = _isolated(bench_directory, tmp, engine, n)
+                result = {'engine': engine, 'jobs': n, 'pages': count, 'bytes': size,
+                          **_throughput(seconds, count, size), 'peak_rss_kb': rss}
+                if n > 1:
+                    result['workers_peak_rss_kb'] = children_rss
+                results['directory'].append(result)
+    return results
+
+
+def _run_ms(command, cwd, env):
+    start = time.perf_counter()
+    subprocess.run(command, cwd=cwd, env=env, stdout=subprocess.DEVNULL, check=True)
+    return (time.perf_counter() - start) * 1000
+
+
+def import_time_ms(directory, env):
+    """Cumulative import time of the doku2md in directory, as reported by python -X importtime."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import doku2md'], cwd=directory, env=env,
+                            stderr=subprocess.PIPE, text=True, check=True)
+    for line in reversed(result.stderr.splitlines()):
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].strip() == 'doku2md':
+            return int(fields[1]) / 1000
+
+
+def bench_startup(converters, runs, seed=1):
+    """Median milliseconds to convert a tiny page in a new process, running doku2md.py or importing it.
+
+    converters maps names to copies of doku2md.py. Each is copied alone to a temporary directory
+    where its compiled code can be cached, as for an installed copy.
+    """
+    env = {name: value for name, value in os.environ.items() if name != 'PYTHONDONTWRITEBYTECODE'}
+    with tempfile.TemporaryDirectory() as tmp:
+        page = os.path.join(tmp, 'page.txt')
+        with open(page, 'w') as f:
+            f.write(generate_page(seed, 'mixed', PAGE_SIZES['tiny']))
+        commands = {('interpreter', 'python -c pass'): ([sys.executable, '-c', 'pass'], tmp)}
+        for name, path in converters.items():
+            directory = os.path.join(tmp, name)
+            os.mkdir(directory)
+            shutil.copy(path, os.path.join(directory, 'doku2md.py'))
+            commands[name, 'script'] = ([sys.executable, 'doku2md.py', '-f', page], directory)
+            # What the doku2md launcher does
+            commands[name, 'imported'] = ([sys.executable, '-c', 'import doku2md; doku2md.main()', '-f', page],
+                                          directory)
+        timings = {key: [] for key in commands}
+        for _ in range(runs + 1):  # the first round writes the compiled modules
+            for key, (command, cwd) in commands.items():
+                timings[key].append(_run_ms(command, cwd, env))
+        results = {}
+        for (name, mode), values in timings.items():
+            results.setdefault(name, {})[mode] = sorted(values[1:])[runs // 2]
+        for name in converters:
+            results[name]['import'] = min(import_time_ms(os.path.join(tmp, name), env) for _ in range(runs))
+    return results
+
+
+def print_startup(results):
+    names = [name for name in results if name != 'interpreter']
+    print(f"{'start up (ms)':<32}" + ''.join(f'{name:>12}' for name in names))
+    print(f"{'python -c pass':<32}{results['interpreter']['python -c pass']:>12.1f}")
+    for mode, label in (('script', 'doku2md.py -f PAGE'), ('imported', 'doku2md -f PAGE (imported)'),
+                        ('import', 'import doku2md (importtime)')):
+        print(f'{label:<32}' + ''.join(f'{results[name][mode]:>12.1f}' for name in names))
+
+
+def compare(old, new):
+    """Print the throughput of two suite results side by side."""
+    print(f"{'benchmark':<34}{'old pages/s':>14}{'new pages/s':>14}{'change':>10}")
+    old_pages = {(p['kind'], p['size'], e): v for p in old['pages'] for e, v in p['engines'].items()}
+    for page in new['pages']:
+        for engine, value in page['engines'].items():
+            before = old_pages.get((page['kind'], page['size'], engine))
+            if before:
+                name = f"{page['kind']}/{page['size']} {engine}"
+                print(f"{name:<34}{before['pages_per_s']:>14.1f}{value['pages_per_s']:>14.1f}"
+                      f"{value['pages_per_s'] / before['pages_per_s'] - 1:>+10.1%}")
+    old_dirs = {(d['engine'], d['jobs']): d for d in old['directory']}
+    for run in new['directory']:
+        before = old_dirs.get((run['engine'], run['jobs']))
+        if before:
+            name = f"directory {run['engine']} -j {run['jobs']}"
+            print(f"{name:<34}{before['pages_per_s']:>14.1f}{run['pages_per_s']:>14.1f}"
+                  f"{run['pages_per_s'] / before['pages_per_s'] - 1:>+10.1%}")
+
+
+def print_transforms(timings, baseline=None):
+    if baseline:
+        print(f"{'transform':<32}{'baseline µs':>14}{'current µs':>14}{'speedup':>10}")
+    else:
+        print(f"{'transform':<32}{'current µs':>14}")
+    for name, seconds in timings.items():
+        if baseline:
+            print(f"{name:<32}{baseline[name] * 1e6:>14.1f}{seconds * 1e6:>14.1f}{baseline[name] / seconds:>9.2f}x")
+        else:
+            print(f"{name:<32}{seconds * 1e6:>14.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Dokuwiki to Markdown converter.')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('-s', '--suite', action='store_true',
+                       help='Run the full benchmark suite on a synthetic corpus and print the results as JSON.')
+    group.add_argument('-g', '--generate', metavar='DIRECTORY', help='Write a synthetic page tree to DIRECTORY.')
+    group.add_argument('-c', '--compare', nargs=2, metavar=('OLD', 'NEW'), help='Compare two --suite JSON results.')
+    group.add_argument('--startup', action='store_true',
+                       help='Time converting a tiny page in a new process, as an editor hook does, and the import time.')
+    parser.add_argument('-f', '--file', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'syntax.txt'),
+                        help='DokuWiki page to time the transforms with (Default is syntax.txt).')
+    parser.add_argument('-b', '--baseline', help='Another doku2md.py to compare the transforms (or --startup) against.')
+    parser.add_argument('--seed', type=int, default=1, help='Seed of the synthetic corpus.')
+    parser.add_argument('--pages', type=int, default=500, help='Number of pages in the synthetic tree.')
+    parser.add_argument('--sizes', nargs='+', choices=PAGE_SIZES, default=list(PAGE_SIZES),
+                        help='Page sizes benchmarked by --suite.')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help='Worker processes for the parallel directory run of --suite.')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='Timing runs per measurement, the best is kept.')
+    parser.add_argument('-o', '--output', help='Write --suite results to this file instead of stdout (or --startup results, as JSON).')
+
+    args = parser.parse_args()
+    if args.generate:
+        count, size = generate_tree(args.generate, args.seed, args.pages)
+        print(f'Wrote {count} pages ({size / 1e6:.1f} MB) to {args.generate}')
+    elif args.compare:
+        with open(args.compare[0]) as old, open(args.compare[1]) as new:
+            compare(json.load(old), json.load(new))
+    elif args.startup:
+        converters = {'current': doku2md.__file__}
+        if args.baseline:
+            converters['baseline'] = args.baseline
+        results = bench_startup(converters, args.repeat * 4, args.seed)
+        print_startup(results)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+    elif args.suite:
+        results = run_suite(args.seed, args.pages, args.jobs, args.repeat, 0.05, args.sizes,
+                            log=lambda message: print(message, file=sys.stderr))
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+        else:
+            print(json.dumps(results, indent=2))
+    else:
+        with open(args.file) as f:
+            text = f.read()
+        baseline = bench_transforms(load_converter(args.baseline), text, args.repeat) if args.baseline else None
+        print_transforms(bench_transforms(DokuWiki2MarkDown, text, args.repeat), baseline)
+
+
+if __name__ == '__main__':
+    main()
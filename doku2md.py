@@ -1,131 +1,942 @@
 #!/usr/bin/env python3
 
-import argparse
 import os
 import re
+import sys
+from collections import deque, namedtuple
 from functools import reduce
+from itertools import islice
+from time import perf_counter
+
+__version__ = '1.2.3'
+
+# Bump when the layout of the incremental conversion manifest changes
+MANIFEST_FORMAT = 1
+MANIFEST_NAME = '.doku2md-manifest.json'
+
+# Conversion engines: the original chain of regex transforms and the single pass tokenizer
+ENGINES = ('regex', 'tokens')
+
+# How pages are delimited when running as a worker (see DokuWiki2MarkDown.serve)
+FRAMINGS = ('nul', 'length')
+
+# Pages from this size on are memory mapped and decoded in place, rather than read into a copy first
+MMAP_SIZE = 1 << 17
+
+# Default size cap of a conversion cache, in bytes (see ConversionCache)
+CACHE_SIZE = 1 << 30
+
+# How the media files referenced by pages are exported (see MediaIndex.export)
+MEDIA_MODES = ('copy', 'link')
+
+# Branch the page history is written to (see DokuWiki2MarkDown.convert_history)
+HISTORY_REF = 'refs/heads/main'
+
+# Archive outputs by file extension: tarfile write modes, and zip (always deflated)
+ARCHIVES = {
+    '.tar': 'w', '.tar.gz': 'w:gz', '.tgz': 'w:gz', '.tar.bz2': 'w:bz2', '.tbz2': 'w:bz2', '.tar.xz': 'w:xz',
+    '.txz': 'w:xz', '.zip': 'zip',
+}
+
+# Classes only some options need, imported from their module when first used (see __getattr__) so that
+# converting a page doesn't load them
+_LAZY_NAMES = {
+    'LinkIndex': 'doku2md_index',
+    'MediaIndex': 'doku2md_index',
+    'ConversionCache': 'doku2md_cache',
+    'ConversionProfile': 'doku2md_profile',
+}
+
+# What converting one page to its .md file gives: the new path, the profile records (None
+# unless profiled) and the notes of the link and media resolvers (None unless indexed)
+ConvertedPage = namedtuple('ConvertedPage', 'path records notes')
 
 
 class DokuWiki2MarkDown:
 
+    # Every pattern used by the converter, compiled once when the class is created.
+    # The regex engine can only skip ahead quickly when a pattern starts with a literal, so
+    # '(\n\s*){2,}' is written as '\n\s*(?:\n\s*)+', '\n*<' as '(?:\n\n*<|<)', and patterns
+    # that used to start with ' *' leave those spaces to _sub_after_spaces.
+    _RE = {
+        'timestamp': re.compile(r'(?:  *Created|Created) \w+ \d{2} \w+ \d{4}\n'),
+        'codeblock': re.compile(r'(?:\n\n*<|<)(?:code|file)[^>]*>\n{0,}(.*?)\n{0,}</(?:code|file)>', re.DOTALL),
+        'codeblock_open': re.compile(r'<(?:code|file)'),
+        'link': re.compile(r'\[\[(.*?)(\|(.*?))?\]\]'),
+        'url_scheme': re.compile(r'\w+://'),
+        # Header levels are tried from the longest marker down, see _tr_headers
+        **{f'header{i}': re.compile(rf"{'=' * i} *(.*?) *{'=' * i} *\s+") for i in range(6, 1, -1)},
+        'italic': re.compile(r'//(.*?)//'),
+        'underline': re.compile(r'__(.*?)__'),
+        'monospaced': re.compile(r"''(.*?)''"),
+        'strikethrough': re.compile(r'<del>(.*?)</del>'),
+        'image': re.compile(r'\{\{(.*?)(\|(.*?))?\}\}'),
+        'footnote': re.compile(r'\(\((.*?)\)\)'),
+        'linebreak': re.compile(r'\\\\ *\n'),
+        'single_space_eol': re.compile(r' (?<!  )(?! )$', re.MULTILINE),
+        'newlines': re.compile(r'\n\s*(?:\n\s*)+'),
+        # Sizes of internal images, see _media_markdown
+        'media_size': re.compile(r'(\d+)(?:x(\d+))?'),
+        # Table cell separators, but not the caret of a footnote reference
+        'table_separator': re.compile(r'((?<!\[)[\^|])'),
+        # Markdown the converter writes in table cells, rewritten as HTML in HTML tables
+        'cell_markup': re.compile(r'`(?P<code>[^`]+)`|(?P<image>!?)\[(?P<title>[^\]]*)\]\((?P<url>[^)\s]*)\)'
+                                  r'|\*\*(?P<strong>.+?)\*\*|\*(?P<em>.+?)\*|~~(?P<del>.+?)~~'
+                                  r'|(?P<img><img src="[^"<>]*" alt="[^"<>]*"[^<>]*>)'),
+    }
+
+    # Transforms run by the regex engine between code block extraction and restoration
+    # - bold and block quotes share the same syntax in DokuWiki and MarkDown
+    _TRANSFORMS = (
+        '_tr_links_initial_escape',
+        '_tr_headers',
+        '_tr_italic',
+        '_tr_underline',
+        '_tr_monospaced',
+        '_tr_strikethrough',
+        '_tr_images',
+        '_tr_footnotes',
+        '_tr_tables',
+        '_tr_lists',
+        '_tr_linebreaks',
+        '_tr_links_unescape',
+        '_rm_single_space_at_line_end',
+        '_rm_newlines',
+    )
+
+    # Byte order marks pages are decoded by (see _decode_page), UTF-32 first as its LE mark starts like UTF-16's
+    _BOMS = (
+        (b'\xff\xfe\x00\x00', 'utf-32'),
+        (b'\x00\x00\xfe\xff', 'utf-32'),
+        (b'\xef\xbb\xbf', 'utf-8-sig'),
+        (b'\xff\xfe', 'utf-16'),
+        (b'\xfe\xff', 'utf-16'),
+    )
+
+    # LinkIndex and MediaIndex of the tree being converted, see _use_indexes
+    _link_index = None
+    _media_index = None
+
     @staticmethod
-    def convert_file(filepath, lang, ts):
+    def convert_file(filepath, lang, ts, engine='regex', profile=None, stream=False, cache=None):
+        if filepath == '-':
+            # Filter mode: stdout only carries the Markdown
+            records = []
+            start = perf_counter()
+            hook = None if profile is None else lambda *record: records.append(record)
+            chars_in, chars_out = DokuWiki2MarkDown._convert_stdio(lang, ts, engine, stream, hook)
+            if profile is not None:
+                profile(filepath, records + [('total', perf_counter() - start, chars_in, chars_out, None)])
+            return
+
         try:
-            with open(filepath, 'r') as f:
-                dokuwiki_text = f.read()
+            page = DokuWiki2MarkDown._convert_path(filepath, lang, ts, engine, stream, cache=cache,
+                                                   profile=profile is not None)
         except FileNotFoundError:
             print(f"Error: File {filepath} not found.")
             return
+        if profile is not None:
+            profile(filepath, page.records)
+        print(f"Saving {page.path}")
+        return page.path
+
+    @staticmethod
+    def convert_directory(directory, lang, ts, jobs=1, manifest=None, prune=False, engine='regex', profile=None,
+                          stream=False, output=None, links=False, media=None, media_mode='copy', cache=None):
+        """Convert every .txt page below directory, using up to jobs worker processes.
+
+        Progress is reported in page order whatever the number of jobs. Pages that fail
+        to convert don't stop the batch; they are returned as a list of (filepath, error).
+
+        With a manifest path the run is incremental: pages whose source and options are
+        unchanged since the last run are skipped, and .md files left behind by deleted
+        pages are reported (or removed when prune is set).
+
+        profile, if given, is called with (filepath, records) for every converted page;
+        see _convert_path and ConversionProfile. With stream set, pages are read and
+        converted piece by piece (see _convert_stream).
+
+        output, if given, is where the .md files go instead of next to their page: a
+        directory, mirroring the namespaces of directory, or an archive (see ARCHIVES)
+        that is written as pages complete. Archives can't be combined with a manifest,
+        a profile or stream.
 
-        markdown_text = DokuWiki2MarkDown._dokuwiki_to_markdown(dokuwiki_text, lang, ts)
+        With links set, every page is first indexed (see LinkIndex), internal links are
+        rewritten to the relative path of the .md file they point to, and links to missing
+        pages or sections are reported.
+
+        media, if given, is the DokuWiki media directory images are resolved against (see
+        MediaIndex): the files referenced by the converted pages are exported next to the
+        .md files, at the place of their namespace, copied or hard linked depending on
+        media_mode (one of MEDIA_MODES), and missing ones are reported.
+
+        cache, if given, is a ConversionCache pages are looked up in before being converted
+        and stored into after. It can't be combined with stream, links or media, whose output
+        doesn't only depend on the page.
+        """
+        if not os.path.isdir(directory):
+            print(f"Error: Directory {directory} not found.")
+            return []
+
+        archive_mode = DokuWiki2MarkDown._archive_mode(output)
+        if archive_mode and (manifest or profile or stream):
+            raise ValueError('an archive output can\'t be combined with a manifest, a profile or stream')
+        if cache and (stream or links or media):
+            raise ValueError('a cache can\'t be combined with stream, links or media')
+        mirror = (directory, output) if output and not archive_mode else None
+
+        filepaths = DokuWiki2MarkDown._find_pages(directory)
+        errors = []
+        notes = []
+        indexed = bool(links or media)
+        if indexed:
+            from doku2md_index import LinkIndex, MediaIndex
+        link_index = LinkIndex(directory, filepaths, jobs) if links else None
+        media_index = MediaIndex(media, directory) if media else None
+        if manifest:
+            options = {'lang': lang, 'timestamps': bool(ts), 'engine': engine}
+            if links:
+                # Adding, removing or retitling a page can change the links of any other page
+                options['links'] = link_index.digest()
+            if media:
+                options['media'] = True
+            old_pages, reusable = DokuWiki2MarkDown._load_manifest(manifest, options)
+            pages, todo, entries = DokuWiki2MarkDown._plan_incremental(
+                directory, filepaths, old_pages if reusable else {}, errors, mirror)
+        else:
+            todo = filepaths
+
+        if archive_mode:
+            from doku2md_archive import add_file_to_archive, add_to_archive, open_archive
+            archive = open_archive(output, archive_mode)
+            convert, convert_args = DokuWiki2MarkDown._convert_text, (lang, ts, engine, indexed, cache)
+        else:
+            convert, convert_args = DokuWiki2MarkDown._convert_path, (lang, ts, engine, stream, mirror, indexed, cache,
+                                                                      profile is not None)
+        # Indexes are handed to every worker process once, rather than with every page
+        initargs = (link_index, media_index)
+        initializer = DokuWiki2MarkDown._use_indexes if indexed else None
+        DokuWiki2MarkDown._use_indexes(*initargs)
+
+        converted = 0
+        media_ids = set()
+        try:
+            for filepath, result in DokuWiki2MarkDown._map_pages(todo, convert_args, jobs, convert,
+                                                                 initializer, initargs):
+                if isinstance(result, Exception):
+                    errors.append((filepath, f'{type(result).__name__}: {result}'))
+                    continue
+                if archive_mode:
+                    markdown_text, page_notes = result
+                    name = os.path.relpath(DokuWiki2MarkDown._md_path(filepath), directory).replace(os.sep, '/')
+                    add_to_archive(archive, archive_mode, name, markdown_text)
+                    new_filepath = f'{output}:{name}'
+                else:
+                    new_filepath, records, page_notes = result
+                    if profile is not None:
+                        profile(filepath, records)
+                for kind, target in page_notes or ():
+                    if kind == 'media':
+                        media_ids.add(target)
+                    else:
+                        notes.append((filepath, kind, target))
+                print(f"Saving {new_filepath}")
+                converted += 1
+                if manifest:
+                    pages[os.path.relpath(filepath, directory)] = entries[filepath]
+
+            # Media files are exported at once, each of them only once however many pages use it
+            if media and archive_mode:
+                for media_id in sorted(media_ids):
+                    add_file_to_archive(archive, archive_mode, media_id.replace(':', '/'), media_index.files[media_id])
+            elif media:
+                media_index.export(media_ids, output or directory, media_mode)
+        finally:
+            DokuWiki2MarkDown._use_indexes(None, None)
+            if archive_mode:
+                archive.close()
+            if cache:
+                cache.trim()
+
+        if manifest:
+            sources = {os.path.relpath(filepath, directory) for filepath in filepaths}
+            for relpath in sorted(old_pages.keys() - sources):
+                orphan = DokuWiki2MarkDown._md_path(os.path.join(directory, relpath), mirror)
+                if not os.path.exists(orphan):
+                    continue
+                if prune:
+                    print(f"Removing orphan {orphan}")
+                    os.remove(orphan)
+                else:
+                    print(f"Orphan {orphan} (source page was removed)")
+                    pages[relpath] = old_pages[relpath]
+            DokuWiki2MarkDown._save_manifest(manifest, options, pages)
+
+        for filepath, error in errors:
+            print(f"Error: {filepath}: {error}")
+        for filepath, kind, target in notes:
+            print(f"{kind.capitalize()}: {filepath}: {target}")
+        summary = f"Converted {converted} of {len(filepaths)} files ({len(errors)} errors)"
+        if manifest:
+            summary += f", {len(filepaths) - converted - len(errors)} unchanged"
+        if links:
+            summary += f", {sum(kind == 'broken link' for _, kind, _ in notes)} broken links"
+        if media:
+            summary += (f", {len(media_ids)} media files"
+                        f" ({sum(kind == 'missing media' for _, kind, _ in notes)} missing)")
+        print(summary)
+        return errors
+
+    @staticmethod
+    def convert_directory_async(directory, lang, ts, engine='regex', concurrency=16, jobs=1, output=None, cache=None):
+        """Return a coroutine converting a directory with the asyncio pipeline, see doku2md_async."""
+        from doku2md_async import convert_directory_async
+        return convert_directory_async(directory, lang, ts, engine, concurrency, jobs, output, cache)
+
+    @staticmethod
+    def convert_pages_async(directory, lang, ts, engine='regex', concurrency=16, jobs=1, output=None, cache=None):
+        """Return an async iterator of the pages converted by the asyncio pipeline, see doku2md_async."""
+        from doku2md_async import convert_pages_async
+        return convert_pages_async(directory, lang, ts, engine, concurrency, jobs, output, cache)
+
+    @staticmethod
+    def convert_history(data_directory, lang, ts, engine='regex', jobs=1, out=None, ref=HISTORY_REF):
+        """Write every revision of a DokuWiki data directory as a git fast-import stream, see doku2md_history."""
+        from doku2md_history import convert_history
+        return convert_history(data_directory, lang, ts, engine, jobs, out, ref)
+
+    @staticmethod
+    def serve(framing, lang, ts, engine='regex', socket_path=None):
+        """Run as a long lived worker converting pages until the end of input, see doku2md_serve."""
+        from doku2md_serve import serve
+        serve(framing, lang, ts, engine, socket_path)
+
+    @staticmethod
+    def _archive_mode(output):
+        """Return the ARCHIVES mode of an output path, or None if it isn't an archive."""
+        if not output:
+            return None
+        name = output.lower()
+        return next((mode for extension, mode in ARCHIVES.items() if name.endswith(extension)), None)
 
+    @staticmethod
+    def _plan_incremental(directory, filepaths, old_pages, errors, mirror=None):
+        """Split pages into unchanged ones and ones to convert.
+
+        Returns the manifest entries of unchanged pages, the pages to convert and the
+        entries to record for them once converted. A page whose size and mtime match
+        its entry is skipped without being read; otherwise its content hash decides.
+        """
+        pages, todo, entries = {}, [], {}
+        for filepath in filepaths:
+            relpath = os.path.relpath(filepath, directory)
+            try:
+                st = os.stat(filepath)
+                entry = old_pages.get(relpath)
+                output_exists = entry is not None and os.path.exists(DokuWiki2MarkDown._md_path(filepath, mirror))
+                if output_exists and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+                    pages[relpath] = entry
+                    continue
+                new_entry = [st.st_size, st.st_mtime_ns, DokuWiki2MarkDown._hash_file(filepath)]
+            except OSError as e:
+                errors.append((filepath, f'{type(e).__name__}: {e}'))
+                continue
+            if output_exists and entry[2] == new_entry[2]:
+                pages[relpath] = new_entry
+            else:
+                todo.append(filepath)
+                entries[filepath] = new_entry
+        return pages, todo, entries
+
+    @staticmethod
+    def _hash_file(filepath):
+        import hashlib
+        with DokuWiki2MarkDown._open_page(filepath) as data:
+            return hashlib.sha256(data).hexdigest()
+
+    @staticmethod
+    def _load_manifest(path, options):
+        """Return the pages recorded in a manifest and whether they can be trusted for skipping.
+
+        Entries are only reusable if they were produced by this converter version with the
+        same options; either way they are still needed to find orphaned outputs.
+        """
+        import json
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}, False
+        if not isinstance(data, dict) or data.get('format') != MANIFEST_FORMAT:
+            return {}, False
+        reusable = data.get('converter') == __version__ and data.get('options') == options
+        return data.get('pages', {}), reusable
+
+    @staticmethod
+    def _save_manifest(path, options, pages):
+        # Pages are stored as compact [size, mtime_ns, sha256] rows to keep big manifests quick to load
+        import json
+        data = {'format': MANIFEST_FORMAT, 'converter': __version__, 'options': options, 'pages': pages}
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, separators=(',', ':'), sort_keys=True)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _find_pages(directory):
+        """List .txt pages below directory in a stable (sorted) order."""
+        filepaths = []
+        for root, dirs, files in os.walk(directory):
+            dirs.sort()
+            for file in sorted(files):
+                if file.endswith('.txt'):
+                    filepaths.append(os.path.join(root, file))
+        return filepaths
+
+    @staticmethod
+    def _scan_directory(path):
+        """Return the sorted subdirectories and .txt pages of one directory, the way os.walk sees them."""
+        subdirs, pages = [], []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            subdirs.append(entry.path)
+                    elif entry.name.endswith('.txt'):
+                        pages.append(entry.path)
+        except OSError:
+            pass  # unreadable directories are skipped, as os.walk does
+        return sorted(subdirs), sorted(pages)
+
+    @staticmethod
+    def _md_path(filepath, mirror=None):
+        """Return where the .md file of a page goes: next to it, or at the same place in a mirror.
+
+        mirror is a (source directory, output directory) pair.
+        """
         new_filepath = os.path.splitext(filepath)[0] + '.md'
-        with open(new_filepath, 'w') as f:
-            print(f"Saving {new_filepath}")
-            f.write(markdown_text)
+        if mirror:
+            new_filepath = os.path.join(mirror[1], os.path.relpath(new_filepath, mirror[0]))
+        return new_filepath
+
+    @staticmethod
+    def _convert_path(filepath, lang, ts, engine='regex', stream=False, mirror=None, indexed=False, cache=None,
+                      profile=False):
+        """Convert one page to its .md file (see _md_path) and return a ConvertedPage.
+
+        With indexed set, links and images are resolved against the installed indexes (see
+        _use_indexes) and the notes are the (kind, target) pairs reported by their resolvers.
+        cache is an optional ConversionCache (not used when streaming or indexed, nor for empty
+        pages).
+
+        With profile set, the records are one (stage, seconds, chars_in, chars_out, matches)
+        tuple per stage of the conversion (of every piece of the page when streaming), followed
+        by ('total', seconds, chars_in, chars_out, None) for the whole page including reading
+        and writing (chars_out is None when it was copied from the cache).
+        """
+        records = []
+        hook = (lambda *record: records.append(record)) if profile else None
+        start = perf_counter()
+        links, media, notes = DokuWiki2MarkDown._page_resolvers(filepath) if indexed else (None, None, None)
+        new_filepath = DokuWiki2MarkDown._md_path(filepath, mirror)
+        if stream:
+            chars_in, chars_out = DokuWiki2MarkDown._stream_page(filepath, new_filepath, lang, ts, engine, hook, links,
+                                                                 media, notes, bool(mirror))
+        else:
+            dokuwiki_text = DokuWiki2MarkDown._read_page(filepath)
+            key = cache.key(dokuwiki_text, (lang, ts, engine)) if cache and dokuwiki_text and not indexed else None
+            chars_in, chars_out = len(dokuwiki_text), None
+            if not (key and cache.copy(key, new_filepath, bool(mirror))):
+                markdown_text = ''
+                if dokuwiki_text:
+                    markdown_text = DokuWiki2MarkDown._dokuwiki_to_markdown(dokuwiki_text, lang, ts, engine, hook,
+                                                                            links=links, media=media)
+                DokuWiki2MarkDown._write_page(new_filepath, markdown_text, bool(mirror))
+                if key:
+                    cache.put(key, markdown_text)
+                chars_out = len(markdown_text)
+        if profile:
+            records.append(('total', perf_counter() - start, chars_in, chars_out, None))
+        return ConvertedPage(new_filepath, records if profile else None, notes)
+
+    @staticmethod
+    def _convert_text(filepath, lang, ts, engine='regex', indexed=False, cache=None):
+        """Convert one page and return (its Markdown, notes), notes as in _convert_path."""
+        links, media, notes = DokuWiki2MarkDown._page_resolvers(filepath) if indexed else (None, None, None)
+        dokuwiki_text = DokuWiki2MarkDown._read_page(filepath)
+        key = cache.key(dokuwiki_text, (lang, ts, engine)) if cache and dokuwiki_text and not indexed else None
+        markdown_text = cache.get(key) if key else None
+        if not dokuwiki_text:
+            markdown_text = ''
+        elif markdown_text is None:
+            markdown_text = DokuWiki2MarkDown._dokuwiki_to_markdown(dokuwiki_text, lang, ts, engine, links=links,
+                                                                    media=media)
+            if key:
+                cache.put(key, markdown_text)
+        return markdown_text, notes
+
+    @staticmethod
+    def _use_indexes(link_index, media_index):
+        """Install the LinkIndex and MediaIndex (either may be None) pages are resolved against.
+
+        Worker processes get them once, as their initializer.
+        """
+        DokuWiki2MarkDown._link_index = link_index
+        DokuWiki2MarkDown._media_index = media_index
+
+    @staticmethod
+    def _page_resolvers(filepath):
+        """Return the link and media resolvers of a page (None without an index) and the list of their notes."""
+        notes = []
+        link_index, media_index = DokuWiki2MarkDown._link_index, DokuWiki2MarkDown._media_index
+        return (link_index and link_index.resolver(filepath, notes),
+                media_index and media_index.resolver(filepath, notes), notes)
+
+    @staticmethod
+    def _read_page(filepath):
+        with DokuWiki2MarkDown._open_page(filepath) as data:
+            return DokuWiki2MarkDown._decode_page(data)
+
+    @staticmethod
+    def _open_page(filepath):
+        """Return the bytes of a page as a buffer to use in a with block.
+
+        Pages of MMAP_SIZE bytes or more are memory mapped, so hashing or decoding them doesn't
+        need a copy of the whole file first.
+        """
+        with open(filepath, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < MMAP_SIZE:
+                return memoryview(f.read())
+            import mmap
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @staticmethod
+    def _decode_page(data):
+        """Decode the bytes of a page, with its newlines normalised as in text mode.
+
+        Pages are decoded according to their byte order mark if they have one, else as UTF-8,
+        else as Latin-1 (which legacy wikis were written in).
+        """
+        encoding = DokuWiki2MarkDown._bom_encoding(bytes(data[:4]))
+        if encoding:
+            text = str(data, encoding)
+        else:
+            try:
+                text = str(data, 'utf-8')
+            except UnicodeDecodeError:
+                text = str(data, 'latin-1')
+        if '\r' in text:
+            text = text.replace('\r\n', '\n').replace('\r', '\n')
+        return text
+
+    @staticmethod
+    def _bom_encoding(head):
+        """Return the encoding given by the byte order mark head starts with, or None."""
+        return next((encoding for bom, encoding in DokuWiki2MarkDown._BOMS if head.startswith(bom)), None)
+
+    @staticmethod
+    def _write_page(filepath, text, makedirs=False):
+        data = text.encode('utf-8')
+
+        def write(tmp_path):
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+        DokuWiki2MarkDown._replace_file(filepath, write, makedirs)
+
+    @staticmethod
+    def _replace_file(filepath, write, makedirs=False):
+        """Create filepath atomically and return what write returns.
+
+        write(path) writes the file under a temporary name next to filepath, which is then renamed
+        over it: readers, or a batch that crashed, see the old file or the new one, never a
+        truncated one. An existing file keeps its permissions, new ones get the umask's default
+        as write creates them.
+        """
+        import shutil
+
+        if makedirs:
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        tmp_path = f'{filepath}.{os.getpid()}.tmp'
+        try:
+            result = write(tmp_path)
+            try:
+                shutil.copymode(filepath, tmp_path)
+            except FileNotFoundError:
+                pass
+            os.replace(tmp_path, filepath)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return result
+
+    @staticmethod
+    def _stream_page(filepath, new_filepath, lang, ts, engine='regex', hook=None, links=None, media=None, notes=None,
+                     makedirs=False):
+        """Convert a page to new_filepath with _convert_stream; returns the number of characters read and written.
+
+        Pages are decoded as _decode_page does: one that turns out not to be UTF-8 half way is
+        converted again from the start as Latin-1, dropping the notes of the first attempt.
+        """
+        with open(filepath, 'rb') as f:
+            encoding = DokuWiki2MarkDown._bom_encoding(f.read(4))
+        encodings = [encoding] if encoding else ['utf-8', 'latin-1']
+        noted = len(notes) if notes else 0
+
+        def write(tmp_path):
+            for encoding in encodings:
+                try:
+                    with open(filepath, 'r', encoding=encoding) as src, \
+                            open(tmp_path, 'w', encoding='utf-8', newline='\n') as dst:
+                        return DokuWiki2MarkDown._convert_stream(src, dst, lang, ts, engine, hook, links=links,
+                                                                 media=media)
+                except UnicodeDecodeError:
+                    if encoding == encodings[-1]:
+                        raise
+                    if notes:
+                        del notes[noted:]
+        return DokuWiki2MarkDown._replace_file(new_filepath, write, makedirs)
+
+    @staticmethod
+    def _convert_stdio(lang, ts, engine='regex', stream=False, hook=None):
+        """Convert the page on stdin to stdout; returns the number of characters read and written.
+
+        The page is decoded as _decode_page does and written in UTF-8, as a .md file would be.
+        When streaming, stdin can't be read again from the start, so a page without a byte order
+        mark is decoded as UTF-8 with only the bytes that aren't UTF-8 taken as Latin-1.
+        """
+        import io
+
+        sys.stdout.flush()
+        if stream:
+            import codecs
+
+            codecs.register_error('doku2md-latin-1', lambda e: (e.object[e.start:e.end].decode('latin-1'), e.end))
+            encoding = DokuWiki2MarkDown._bom_encoding(sys.stdin.buffer.peek(4)[:4])
+            src = io.TextIOWrapper(sys.stdin.buffer, encoding or 'utf-8', 'doku2md-latin-1')
+            dst = io.TextIOWrapper(sys.stdout.buffer, 'utf-8', newline='\n', write_through=True)
+            try:
+                return DokuWiki2MarkDown._convert_stream(src, dst, lang, ts, engine, hook)
+            finally:
+                # Leave the standard streams open
+                src.detach()
+                dst.detach()
+        dokuwiki_text = DokuWiki2MarkDown._decode_page(sys.stdin.buffer.read())
+        markdown_text = DokuWiki2MarkDown._dokuwiki_to_markdown(dokuwiki_text, lang, ts, engine, hook)
+        sys.stdout.buffer.write(markdown_text.encode('utf-8'))
+        sys.stdout.buffer.flush()
+        return len(dokuwiki_text), len(markdown_text)
+
+    @staticmethod
+    def _convert_stream(src, dst, lang, ts, engine='regex', hook=None, chunk_size=1 << 20, links=None, media=None,
+                        max_piece=1 << 24):
+        """Convert the page read from file src to file dst, about chunk_size characters at a time.
+
+        The page is cut where no conversion rule can tell the difference (see _stream_boundary)
+        and each piece is converted with a sentinel line standing for the text around it, which
+        is dropped from the output. Memory only depends on chunk_size and on the longest stretch
+        of the page without a cut, itself capped to max_piece characters: longer stretches (such
+        as a long list or a code block that is never closed) are cut at their last line start
+        anyway. Footnote and ordered list numbering go on across pieces, but a table or code block
+        cut that way may come out differently than when converting the whole page. Returns the
+        number of characters read and written.
+        """
+        footnotes = [0]
+        numbering = [0]
+        buffer = ''
+        scanned = 0  # where _stream_boundary resumes, everything before has been looked at
+        first = True
+        chars_in = chars_out = 0
+        while True:
+            data = src.read(chunk_size)
+            buffer += data
+            last = not data
+            if last:
+                cut = len(buffer)
+            else:
+                cut, scanned = DokuWiki2MarkDown._stream_boundary(buffer, scanned)
+                if not cut and len(buffer) >= max_piece:
+                    cut = buffer.rfind('\n') + 1
+                if not cut:
+                    continue
+            piece, buffer = buffer[:cut], buffer[cut:]
+            scanned = max(scanned - cut, 0)
+            chars_in += len(piece)
+
+            sentinel = next(chr(c) for c in range(0xE000, 0xF900) if chr(c) not in piece)
+            text = piece if first else f'{sentinel}\n{piece}'
+            if not last:
+                text += sentinel  # pieces end at a line start
+            markdown = DokuWiki2MarkDown._dokuwiki_to_markdown(text, lang, ts, engine, hook, footnotes, links, media,
+                                                               numbering)
+            # The sentinel line comes out as is, followed by a newline
+            if not first:
+                markdown = markdown[len(sentinel) + 1:]
+            if not last:
+                markdown = markdown[:-len(sentinel) - 1]
+
+            dst.write(markdown)
+            chars_out += len(markdown)
+            first = False
+            if last:
+                return chars_in, chars_out
+
+    @staticmethod
+    def _stream_boundary(buffer, start=0):
+        """Return (cut, scanned): the last position buffer can be cut at without changing its conversion, or 0, and
+        where to resume looking once more text has been appended to buffer.
+
+        Only the text from start on is looked at, so that each character of a growing buffer is
+        scanned once. Cuts are made at the start of a line, outside code blocks (including ones
+        whose end isn't in the buffer yet), and only once that whole line is in the buffer. The
+        line must not start with whitespace or be a list item or table row, as no transform
+        matches across such a line start and the line ends any table or list. After a blank
+        line, which ends them as well, lists and tables may also start at the cut, if not
+        indented enough to be nested. Lines that are removed or may turn blank (timestamps, code
+        blocks, forced line breaks) are never cut before, see _stream_cut.
+        """
+        cut = 0
+        pos = start
+        last = buffer.rfind('\n')  # lines after it aren't complete yet
+        while True:
+            opener = DokuWiki2MarkDown._RE['codeblock_open'].search(buffer, pos)
+            limit = min(opener.start(), last) if opener else last
+            newline = buffer.find('\n', pos, limit)
+            while newline != -1:
+                line_end = buffer.find('\n', newline + 1)
+                after_blank = not newline or buffer[newline - 1] == '\n'
+                if DokuWiki2MarkDown._stream_cut(buffer[newline + 1:line_end], after_blank):
+                    cut = newline + 1
+                newline = buffer.find('\n', line_end, limit)
+            if not opener or opener.start() > last:
+                return cut, max(pos, limit)
+            # A code block takes the newlines before it, from the last one up to its end
+            block_start = opener.start()
+            while block_start > pos and buffer[block_start - 1] == '\n':
+                block_start -= 1
+            block = DokuWiki2MarkDown._RE['codeblock'].match(buffer, block_start)
+            if not block:
+                return cut, block_start  # not closed yet
+            pos = block.end()
+
+    @staticmethod
+    def _stream_cut(line, after_blank):
+        item = line.lstrip()
+        # Code blocks take the newlines before them, and a forced line break alone on its line
+        # becomes a blank line, merged with the ones before
+        if not item or line.startswith('Created ') or item[0] in '<\\':
+            return False
+        if item[0] in '-*|^':
+            # Nested list items would lose their indentation to _rm_newlines after the blank line
+            return after_blank and len(line) - len(item) < 4
+        return len(item) == len(line)
 
     @staticmethod
-    def convert_directory(directory, lang, ts):
+    def _map_pages(filepaths, convert_args, jobs, convert=None, initializer=None, initargs=()):
+        """Yield (filepath, convert result or exception) for every page, in input order.
+
+        convert (_convert_path by default) is called with the page path and convert_args.
+        Worker processes are set up with initializer(*initargs) if given.
+        """
+        convert = convert or DokuWiki2MarkDown._convert_path
+        if jobs == 1:
+            for filepath in filepaths:
+                try:
+                    yield filepath, convert(filepath, *convert_args)
+                except Exception as e:
+                    yield filepath, e
+            return
+
+        from concurrent.futures import ProcessPoolExecutor
+        from concurrent.futures.process import BrokenProcessPool
+
+        # Keep a bounded window of pages in flight so huge trees don't queue every future at once
+        window = jobs * 4
+        todo = iter(filepaths)
+        pending = deque()
+        executor = ProcessPoolExecutor(max_workers=jobs, initializer=initializer, initargs=initargs)
         try:
-            for root, dirs, files in os.walk(directory):
-                for file in files:
-                    if file.endswith('.txt'):
-                        DokuWiki2MarkDown.convert_file(os.path.join(root, file), lang, ts)
-        except NotADirectoryError:
-            print(f"Error: Directory {directory} not found.")
+            while True:
+                for filepath in islice(todo, window - len(pending)):
+                    future = executor.submit(convert, filepath, *convert_args)
+                    pending.append((filepath, future))
+                if not pending:
+                    break
+                filepath, future = pending.popleft()
+                try:
+                    yield filepath, future.result()
+                except BrokenProcessPool:
+                    # A worker died (segfault, OOM kill...): we can't tell which page did it,
+                    # so rerun every page that was in flight in its own process.
+                    executor.shutdown(wait=False)
+                    executor = ProcessPoolExecutor(max_workers=jobs, initializer=initializer, initargs=initargs)
+                    retry = [filepath] + [fp for fp, _ in pending]
+                    pending.clear()
+                    for filepath in retry:
+                        yield filepath, DokuWiki2MarkDown._convert_isolated(filepath, convert_args, convert,
+                                                                            initializer, initargs)
+                except Exception as e:
+                    yield filepath, e
+        finally:
+            executor.shutdown(cancel_futures=True)
 
     @staticmethod
-    def _dokuwiki_to_markdown(dokuwiki_text, codeblk_lang, timestamps):
-
-        # Remove timestamps if elected
-        if not timestamps:
-            dokuwiki_text = DokuWiki2MarkDown._rm_timestamp(dokuwiki_text)
-
-        # Extract and protect code blocks before other transformations
-        codeblocks, dokuwiki_text = DokuWiki2MarkDown._extract_codeblocks(dokuwiki_text, codeblk_lang)
-
-        # Transform the rest ()
-        # - bold and block quotes share the same syntax in DokuWiki and MarkDown
-        transforms = [
-            DokuWiki2MarkDown._tr_links_initial_escape,
-            DokuWiki2MarkDown._tr_headers,
-            DokuWiki2MarkDown._tr_italic,
-            DokuWiki2MarkDown._tr_underline,
-            DokuWiki2MarkDown._tr_monospaced,
-            DokuWiki2MarkDown._tr_strikethrough,
-            DokuWiki2MarkDown._tr_images,
-            DokuWiki2MarkDown._tr_footnotes,
-            DokuWiki2MarkDown._tr_tables,
-            DokuWiki2MarkDown._tr_lists,
-            DokuWiki2MarkDown._tr_linebreaks,
-            DokuWiki2MarkDown._tr_links_unescape,
-            DokuWiki2MarkDown._rm_single_space_at_line_end,
-            DokuWiki2MarkDown._rm_newlines
-            ]
-        dokuwiki_text = reduce(lambda text, func: func(text), transforms, dokuwiki_text)
+    def _convert_isolated(filepath, convert_args, convert, initializer=None, initargs=()):
+        from concurrent.futures import ProcessPoolExecutor
+        from concurrent.futures.process import BrokenProcessPool
+
+        with ProcessPoolExecutor(max_workers=1, initializer=initializer, initargs=initargs) as executor:
+            try:
+                return executor.submit(convert, filepath, *convert_args).result()
+            except BrokenProcessPool:
+                return RuntimeError('worker process crashed')
+            except Exception as e:
+                return e
+
+    @staticmethod
+    def _dokuwiki_to_markdown(dokuwiki_text, codeblk_lang, timestamps, engine='regex', hook=None, footnotes=None,
+                              links=None, media=None, numbering=None):
+        """Convert a page; hook, if given, is called after every stage as described in _run_stages.
+
+        footnotes is a one item list holding the number of footnotes seen so far, for pages
+        converted piece by piece (see _convert_stream); numbering likewise holds the ordered
+        list counter the first line of the piece, standing for the previous pieces, leaves,
+        and is set to the counter before its last line. links, if given, turns the target of
+        every link into its Markdown target (see LinkIndex.resolver) instead of _link_target;
+        media does the same for images (see MediaIndex.resolver and _image_markdown).
+        """
+        if engine == 'tokens':
+            from doku2md_tokens import tokens_to_markdown
+            return tokens_to_markdown(dokuwiki_text, codeblk_lang, timestamps, hook, footnotes, links, media, numbering)
+
+        codeblocks = []
 
+        def extract_codeblocks(text):
+            blocks, text = DokuWiki2MarkDown._extract_codeblocks(text, codeblk_lang)
+            codeblocks.extend(blocks)
+            return text
+
+        # Remove timestamps if elected, then extract and protect code blocks before other transformations
+        stages = [] if timestamps else [('_rm_timestamp', DokuWiki2MarkDown._rm_timestamp)]
+        stages.append(('_extract_codeblocks', extract_codeblocks))
+        # Transform the rest, numbering footnotes on from the previous pieces of the page if any
+        bound = {'_tr_links_initial_escape': lambda text: DokuWiki2MarkDown._tr_links_initial_escape(text, links),
+                 '_tr_images': lambda text: DokuWiki2MarkDown._tr_images(text, media),
+                 '_tr_footnotes': lambda text: DokuWiki2MarkDown._tr_footnotes(text, footnotes),
+                 '_tr_lists': lambda text: DokuWiki2MarkDown._tr_lists(text, numbering)}
+        stages += [(name, bound.get(name) or getattr(DokuWiki2MarkDown, name))
+                   for name in DokuWiki2MarkDown._TRANSFORMS]
         # Restore code blocks
-        dokuwiki_text = DokuWiki2MarkDown._restore_codeblocks(dokuwiki_text, codeblocks)
+        stages.append(('_restore_codeblocks', lambda text: DokuWiki2MarkDown._restore_codeblocks(text, codeblocks)))
+        dokuwiki_text = DokuWiki2MarkDown._run_stages(stages, dokuwiki_text, hook)
 
         # Strip leading/trailing whitespace
         return dokuwiki_text.strip() + '\n' if dokuwiki_text.strip() else ''
 
+    @staticmethod
+    def _run_stages(stages, text, hook=None):
+        """Run text through the (name, func) stages in order.
+
+        With a hook, every stage is timed and reported as hook(name, seconds, chars_in,
+        chars_out, matches), matches being how many times the stage's pattern occurs in its
+        input (None if it has none). Without one the stages run back to back, untimed.
+        """
+        if hook is None:
+            return reduce(lambda text, stage: stage[1](text), stages, text)
+        from doku2md_profile import STAGE_MATCHES
+        for name, func in stages:
+            start = perf_counter()
+            result = func(text)
+            seconds = perf_counter() - start
+            pattern = STAGE_MATCHES.get(name)
+            matches = None if pattern is None else sum(1 for _ in pattern.finditer(text))
+            hook(name, seconds, len(text), len(result), matches)
+            text = result
+        return text
+
+    @staticmethod
+    def _sub_after_spaces(pattern, repl, text):
+        """Same as re.sub(' *' + pattern.pattern, repl, text).
+
+        Looking for the pattern itself and dropping the spaces in front of each match gives
+        the same result, without a match attempt at every space of the page.
+        """
+        out = []
+        pos = 0
+        for match in pattern.finditer(text):
+            out.append(text[pos:match.start()].rstrip(' '))
+            out.append(match.expand(repl))
+            pos = match.end()
+        if not out:
+            return text
+        out.append(text[pos:])
+        return ''.join(out)
+
     @staticmethod
     def _rm_timestamp(text: str) -> str:
-        return re.sub(r' *Created \w+ \d{2} \w+ \d{4}\n', '', text)
+        if 'Created ' not in text:
+            return text
+        return DokuWiki2MarkDown._RE['timestamp'].sub('', text)
 
     @staticmethod
     def _tr_italic(text: str) -> str:
-        return re.sub(r'//(.*?)//', r'*\1*', text)
+        return DokuWiki2MarkDown._RE['italic'].sub(r'*\1*', text)
 
     @staticmethod
     def _tr_underline(text: str) -> str:
         # Underline (not supported in Markdown, converted to bold)
-        return re.sub(r'__(.*?)__', r'**\1**', text)
+        return DokuWiki2MarkDown._RE['underline'].sub(r'**\1**', text)
 
     @staticmethod
     def _tr_monospaced(text: str) -> str:
-        return re.sub(r'\'\'(.*?)\'\'', r'`\1`', text)
+        return DokuWiki2MarkDown._RE['monospaced'].sub(r'`\1`', text)
 
     @staticmethod
     def _tr_strikethrough(text: str) -> str:
-        return re.sub(r'<del>(.*?)</del>', r'~~\1~~', text)
+        return DokuWiki2MarkDown._RE['strikethrough'].sub(r'~~\1~~', text)
 
     @staticmethod
-    def _tr_links_initial_escape(text: str) -> str:
+    def _tr_links_initial_escape(text: str, links=None) -> str:
         def replace_link(match):
             url, _, title = match.groups()
             if not title:
                 title = url
 
-            # Convert DokuWiki namespace separators to path separators for internal links
-            if not re.match(r'\w+://', url) and '>' not in url:
-                url = url.replace(':', '/')
+            url = (links or DokuWiki2MarkDown._link_target)(url)
 
             # hack to avoid italic, bold, underline getting crushed
-            url = re.sub(r'/', "##URL#ESCAPED#SLASH##", url)
-            url = re.sub(r'\*', "##URL#ESCAPED#ASTERISK##", url)
-            url = re.sub(r'_', "##URL#ESCAPED#UNDERSCORE##", url)
+            url = url.replace('/', "##URL#ESCAPED#SLASH##")
+            url = url.replace('*', "##URL#ESCAPED#ASTERISK##")
+            url = url.replace('_', "##URL#ESCAPED#UNDERSCORE##")
 
-            title = re.sub(r'/', "##URL#ESCAPED#SLASH##", title)
-            title = re.sub(r'\*', "##URL#ESCAPED#ASTERISK##", title)
-            title = re.sub(r'_', "##URL#ESCAPED#UNDERSCORE##", title)
+            title = title.replace('/', "##URL#ESCAPED#SLASH##")
+            title = title.replace('*', "##URL#ESCAPED#ASTERISK##")
+            title = title.replace('_', "##URL#ESCAPED#UNDERSCORE##")
 
             return f'[{title}]({url})'
-        return re.sub(r'\[\[(.*?)(\|(.*?))?\]\]', replace_link, text)
+        return DokuWiki2MarkDown._RE['link'].sub(replace_link, text)
+
+    @staticmethod
+    def _link_target(url):
+        # Convert DokuWiki namespace separators to path separators for internal links
+        if not DokuWiki2MarkDown._RE['url_scheme'].match(url) and '>' not in url:
+            url = url.replace(':', '/')
+        return url
 
     @staticmethod
     def _tr_links_unescape(text: str) -> str:
-        text = re.sub("##URL#ESCAPED#SLASH##", "/", text)
-        text = re.sub("##URL#ESCAPED#ASTERISK##", "*", text)
-        text = re.sub("##URL#ESCAPED#UNDERSCORE##", "_", text)
-        
+        text = text.replace("##URL#ESCAPED#SLASH##", "/")
+        text = text.replace("##URL#ESCAPED#ASTERISK##", "*")
+        text = text.replace("##URL#ESCAPED#UNDERSCORE##", "_")
+
         return text
 
     @staticmethod
     def _tr_headers(text: str) -> str:
         for i in range(6, 1, -1):
-            text = re.sub(rf" *{'=' * i} *(.*?) *{'=' * i} *\s+", rf"{'#' * (7 - i)} \1\n\n", text)
+            pattern = DokuWiki2MarkDown._RE[f'header{i}']
+            text = DokuWiki2MarkDown._sub_after_spaces(pattern, rf"{'#' * (7 - i)} \1\n\n", text)
         return text
 
     @staticmethod
@@ -142,8 +953,7 @@ class DokuWiki2MarkDown:
             counter[0] += 1
             return placeholder
 
-        text = re.sub(r'\n*<(?:code|file)[^>]*>\n{0,}(.*?)\n{0,}</(?:code|file)>',
-                      replace_with_placeholder, text, flags=re.DOTALL)
+        text = DokuWiki2MarkDown._RE['codeblock'].sub(replace_with_placeholder, text)
         return codeblocks, text
 
     @staticmethod
@@ -156,139 +966,455 @@ class DokuWiki2MarkDown:
 
 
     @staticmethod
-    def _tr_images(text: str) -> str:
+    def _tr_images(text: str, media=None) -> str:
         """Convert images, using filename as alt text if not provided."""
         def replace_image(match):
-            image_path = match.group(1)
-            alt_text = match.group(3)
+            return DokuWiki2MarkDown._image_markdown(match.group(1), match.group(3), media)
 
-            # Convert DokuWiki namespace separators to path separators for internal images
-            if not re.match(r'https?://', image_path.strip()):
-                image_path = image_path.lstrip(':')
-                image_path = image_path.replace(':', '/')
+        return DokuWiki2MarkDown._RE['image'].sub(replace_image, text)
 
-            # If no alt text provided, use the filename (without path and extension)
-            if not alt_text:
-                # Extract filename from path, remove query params and extension for alt text
-                filename = image_path.split('/')[-1].split('?')[0]
-                # Remove extension
-                alt_text = filename.rsplit('.', 1)[0] if '.' in filename else filename
+    @staticmethod
+    def _image_markdown(image_path, alt_text, media=None):
+        external = image_path.strip().startswith(('http://', 'https://'))
+        if media is not None and not external:
+            return DokuWiki2MarkDown._media_markdown(image_path, alt_text, media)
 
-            return f'![{alt_text}]({image_path})'
+        # Convert DokuWiki namespace separators to path separators for internal images
+        if not external:
+            image_path = image_path.lstrip(':')
+            image_path = image_path.replace(':', '/')
+
+        # If no alt text provided, use the filename (without path and extension)
+        if not alt_text:
+            # Extract filename from path, remove query params and extension for alt text
+            filename = image_path.split('/')[-1].split('?')[0]
+            # Remove extension
+            alt_text = filename.rsplit('.', 1)[0] if '.' in filename else filename
 
-        return re.sub(r'\{\{(.*?)(\|(.*?))?\}\}', replace_image, text)
+        return f'![{alt_text}]({image_path})'
 
     @staticmethod
-    def _tr_footnotes(text: str) -> str:
-        """Convert footnotes with unique numbering."""
-        counter = [0]  # Use list to allow modification in nested function
+    def _media_markdown(image_path, alt_text, media):
+        """Convert an internal image whose path is resolved by media (see MediaIndex.resolver).
+
+        Markdown images can't be sized, so images with a size (?width, ?widthxheight or
+        ?0xheight) become HTML images.
+        """
+        image_path, _, params = image_path.strip().partition('?')
+        image_path = media(image_path)
+        if not alt_text:
+            filename = image_path.split('/')[-1]
+            alt_text = filename.rsplit('.', 1)[0] if '.' in filename else filename
+
+        size = next(filter(None, map(DokuWiki2MarkDown._RE['media_size'].fullmatch, params.split('&'))), None)
+        if size is None:
+            return f'![{alt_text}]({image_path})'
+        width, height = size.groups()
+        attributes = f' width="{width}"' if int(width) else ''
+        attributes += f' height="{height}"' if height else ''
+        alt_text = alt_text.replace('"', '&quot;')
+        return f'<img src="{image_path}" alt="{alt_text}"{attributes}>'
+
+    @staticmethod
+    def _tr_footnotes(text: str, counter=None) -> str:
+        """Convert footnotes with unique numbering, continuing from counter if given."""
+        if counter is None:
+            counter = [0]  # Use list to allow modification in nested function
 
         def replace_footnote(match):
             counter[0] += 1
             footnote_text = match.group(1)
             return f'[^{counter[0]}]\n\n[^{counter[0]}]: {footnote_text}'
 
-        return re.sub(r'\(\((.*?)\)\)', replace_footnote, text)
+        return DokuWiki2MarkDown._RE['footnote'].sub(replace_footnote, text)
 
     @staticmethod
     def _tr_linebreaks(text: str) -> str:
-        return re.sub(r' *\\{2} *\n', r'  \n', text)
+        return DokuWiki2MarkDown._sub_after_spaces(DokuWiki2MarkDown._RE['linebreak'], r'  \n', text)
 
     @staticmethod
-    def _tr_lists(text: str) -> str:
+    def _tr_lists(text: str, numbering=None) -> str:
         lines = text.split('\n')
         ordered_list_counter = 0
+        last = len(lines) - 1
+        while last and not lines[last]:  # _tr_tables ends the text with a newline
+            last -= 1
         for i, line in enumerate(lines):
-            match = re.match(r'(\s*)([-*])(.*)', line)
-            if match and not line.startswith("----"):
-                spaces, bullet, rest = match.groups()
-                indentation = len(spaces) // 2 - 1
-                if bullet == '-':
-                    ordered_list_counter += 1
-                    bullet = str(ordered_list_counter) + '.'
-                else:
-                    # It's an unordered list item
-                    bullet = '*'
-                    # Reset counter when encountering an unordered list item
-                    ordered_list_counter = 0
-                lines[i] = '  '*indentation + bullet + rest
+            if numbering is not None and i == last:
+                numbering[0] = ordered_list_counter
+            lines[i], ordered_list_counter = DokuWiki2MarkDown._list_item(line, ordered_list_counter)
+            if not i and numbering:
+                # Numbering goes on from the previous pieces of the page, see _dokuwiki_to_markdown
+                ordered_list_counter = numbering[0] or ordered_list_counter
+        return '\n'.join(lines)
+
+    @staticmethod
+    def _list_item(line, ordered_list_counter):
+        """Convert one line if it is a list item; return it with the updated ordered list counter."""
+        # Same as matching (\s*)([-*])(.*) but without a regex call per line
+        item = line.lstrip()
+        if item[:1] in ('-', '*') and not line.startswith("----"):
+            spaces, bullet, rest = line[:len(line) - len(item)], item[0], item[1:]
+            indentation = len(spaces) // 2 - 1
+            if bullet == '-':
+                ordered_list_counter += 1
+                bullet = str(ordered_list_counter) + '.'
             else:
-                # Reset counter when encountering a non-list line
+                # It's an unordered list item
+                bullet = '*'
+                # Reset counter when encountering an unordered list item
                 ordered_list_counter = 0
-        return '\n'.join(lines)
+            return '  '*indentation + bullet + rest, ordered_list_counter
+        # Reset counter when encountering a non-list line
+        return line, 0
 
     @staticmethod
     def _tr_tables(input_dokuwiki):
         lines = input_dokuwiki.strip().split('\n')  # Splitting the DokuWiki text into lines
-        in_table = False  # Flag to indicate whether we are currently processing a table
         output_markdown = []  # List to store the converted Markdown lines
-        added_separator = False  # Flag to indicate whether the separator line has been added
+        table = []  # Lines of the table we are currently in
 
         for line in lines:
             # Check if the line is part of a table (starts with ^ for headers or | for regular cells)
-            if re.match(r'\s*(\^|\|).*', line):
-                if not in_table:  # Entering a table
-                    in_table = True
-                    added_separator = False  # Reset the separator flag
-
-                # Replace ^ with | for headers
-                line = re.sub(r'\^', '|', line)
-
-                # Handle colspan (||) by replacing it with empty cell markers (| |)
-                line = re.sub(r'\|\|', '| |', line)
-
-                # Remove rowspan indicators (:::)
-                line = re.sub(r':::', '', line)
-
-                # Add table separator after header row, if not already added
-                if re.match(r'\|.*\|', line) and not added_separator:
-                    output_markdown.append(line.strip())
-                    num_columns = line.count('|') - 1
-                    separator = '| ' + ' --- |' * num_columns
-                    output_markdown.append(separator)
-                    added_separator = True  # Set the separator flag
-                elif not added_separator:
-                    # If it's a header row but the separator is not yet added
-                    output_markdown.append(line.strip())
-                else:
-                    # Append other processed lines to the Markdown text
-                    output_markdown.append(line.strip())
-
-            else:
-                # We are outside a table, reset the flag
-                if in_table:
-                    in_table = False
-                output_markdown.append(line)
+            if line.lstrip()[:1] in ('^', '|'):
+                table.append(line)
+                continue
+            if table:
+                output_markdown.extend(DokuWiki2MarkDown._render_table(table))
+                table = []
+            output_markdown.append(line)
+        if table:
+            output_markdown.extend(DokuWiki2MarkDown._render_table(table))
 
         # Join the Markdown lines into a single string and return
         text = '\n'.join(output_markdown)
         return text + '\n'
 
+    @staticmethod
+    def _render_table(rows):
+        """Convert the DokuWiki lines of one table to Markdown lines.
+
+        Tables whose cells span several columns or rows can't be written in Markdown, they
+        become HTML tables.
+        """
+        grid, spans = DokuWiki2MarkDown._parse_table(rows)
+        if not any(grid):
+            return list(rows)  # lone separators, such as a '|' line, aren't a table
+        if spans:
+            return DokuWiki2MarkDown._html_table(grid)
+        return DokuWiki2MarkDown._gfm_table(grid)
+
+    @staticmethod
+    def _parse_table(rows):
+        """Parse the lines of a table into a grid of cells, in a single pass.
+
+        Cells are [header, text, align, colspan, rowspan] lists, text keeping its padding.
+        An empty cell ('||') widens the cell before it and a ':::' cell lengthens the one
+        above it, so neither is in the grid. Returns (grid, whether any cell spans).
+        """
+        grid = []
+        above = {}  # column -> last cell starting in it
+        spans = False
+        for line in rows:
+            parts = DokuWiki2MarkDown._RE['table_separator'].split(line.strip())
+            row = []
+            column = 0
+            for i in range(1, len(parts), 2):
+                text = parts[i + 1]
+                # Rows end with a separator; anything after it is only kept if it isn't blank
+                if i + 2 == len(parts) and (not text or text.isspace()):
+                    break
+                if not text and row:
+                    row[-1][3] += 1
+                    spans = True
+                elif text.strip() == ':::' and column in above:
+                    above[column][4] += 1
+                    spans = True
+                else:
+                    cell = [parts[i] == '^', text, DokuWiki2MarkDown._cell_align(text), 1, 1]
+                    row.append(cell)
+                    above[column] = cell
+                column += 1
+            grid.append(row)
+        return grid, spans
+
+    @staticmethod
+    def _cell_align(text):
+        # As in DokuWiki: two spaces on the left align right, on the right align left, on both sides center
+        if not text or text.isspace():
+            return None
+        left = text[:2] == '  '
+        right = text[-2:] == '  '
+        if left and right:
+            return 'center'
+        return 'right' if left else 'left' if right else None
+
+    @staticmethod
+    def _gfm_table(grid):
+        """Write a grid without spans as a GFM table.
+
+        The first row is the header row if its cells are headers (an empty corner cell
+        aside), otherwise the table gets an empty one. Other header cells are written in
+        bold. Columns are aligned the way most of their cells are.
+        """
+        width = max(map(len, grid))
+        head = grid[0]
+        if any(cell[0] for cell in head) and all(cell[0] or cell[1].isspace() or not cell[1] for cell in head):
+            body = grid[1:]
+        else:
+            head, body = [], grid
+
+        alignments = [{} for _ in range(width)]
+        for row in grid:
+            for column, cell in enumerate(row):
+                align = cell[2] if cell[2] in ('right', 'center') else 'left'
+                alignments[column][align] = alignments[column].get(align, 0) + 1
+        markers = {'left': '---', 'right': '---:', 'center': ':---:'}
+        separator = [markers[max(counts, key=counts.get) if counts else 'left'] for counts in alignments]
+
+        def line(cells):
+            return '|' + '|'.join(cells + [' '] * (width - len(cells))) + '|'
+
+        lines = [line([cell[1] for cell in head]), '| ' + ' | '.join(separator) + ' |']
+        for row in body:
+            lines.append(line([DokuWiki2MarkDown._bold_cell(cell[1]) if cell[0] else cell[1] for cell in row]))
+        return lines
+
+    @staticmethod
+    def _bold_cell(text):
+        content = text.strip()
+        if not content:
+            return text
+        start = text.index(content)
+        return f'{text[:start]}**{content}**{text[start + len(content):]}'
+
+    @staticmethod
+    def _html_table(grid):
+        """Write a grid as an HTML table, one line per row."""
+        lines = ['<table>']
+        for row in grid:
+            cells = []
+            for header, text, align, colspan, rowspan in row:
+                tag = 'th' if header else 'td'
+                attributes = f' colspan="{colspan}"' if colspan > 1 else ''
+                attributes += f' rowspan="{rowspan}"' if rowspan > 1 else ''
+                # Header cells are centered by default, other cells aligned left
+                if align in ('right', 'center') or (align and header):
+                    attributes += f' align="{align}"'
+                # Link titles and urls are not escaped from the emphasis transforms in HTML
+                html = DokuWiki2MarkDown._html_cell(DokuWiki2MarkDown._tr_links_unescape(text.strip()))
+                cells.append(f'<{tag}{attributes}>{html}</{tag}>')
+            lines.append('<tr>' + ''.join(cells) + '</tr>')
+        lines.append('</table>')
+        return lines
+
+    @staticmethod
+    def _html_cell(text):
+        """Write the Markdown of a cell as HTML, which is all Markdown renderers read inside a <td>."""
+        from html import escape
+
+        def replace(match):
+            kind = match.lastgroup
+            if kind == 'img':  # sized images are already HTML, see _media_markdown
+                return match['img']
+            if kind == 'code':
+                return f'<code>{escape(match["code"], quote=False)}</code>'
+            if kind in ('title', 'url'):
+                if match['image']:
+                    return f'<img src="{escape(match["url"])}" alt="{escape(match["title"])}">'
+                return f'<a href="{escape(match["url"])}">{DokuWiki2MarkDown._html_cell(match["title"])}</a>'
+            tag = {'strong': 'strong', 'em': 'em', 'del': 'del'}[kind]
+            return f'<{tag}>{DokuWiki2MarkDown._html_cell(match[kind])}</{tag}>'
+
+        pattern = DokuWiki2MarkDown._RE['cell_markup']
+        html = []
+        end = 0
+        for match in pattern.finditer(text):
+            html.append(escape(text[end:match.start()], quote=False))
+            html.append(replace(match))
+            end = match.end()
+        html.append(escape(text[end:], quote=False))
+        return ''.join(html)
+
     @staticmethod
     def _rm_newlines(text: str) -> str:
         """Remove any excessive (2+) newlines and replace with 2 \n"""
-        return re.sub(r'(\n\s*){2,}', r'\n\n', text)
+        return DokuWiki2MarkDown._RE['newlines'].sub(r'\n\n', text)
 
     @staticmethod
     def _rm_single_space_at_line_end(text: str) -> str:
-        return re.sub(r'(?<! ) (?! )$', '', text, flags=re.MULTILINE)
+        return DokuWiki2MarkDown._RE['single_space_eol'].sub('', text)
+
+def __getattr__(name):
+    if name in _LAZY_NAMES:
+        import importlib
+        return getattr(importlib.import_module(_LAZY_NAMES[name]), name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def _file_args(argv):
+    """Parse argv without argparse when it only asks to convert files (-f, -l, -T and -e), else return None.
+
+    Editor hooks convert a page on every save, where importing and setting up argparse is a good
+    part of the run time. Anything unusual is left to argparse, which also reports the errors.
+    """
+    files, lang, ts, engine = [], None, False, 'regex'
+    args = iter(argv)
+    option = None
+    for arg in args:
+        if not arg.startswith('-') or arg == '-':
+            # More paths after -f FILE
+            if option not in ('-f', '--file'):
+                return None
+            files.append(arg)
+            continue
+        option, equals, value = arg.partition('=') if arg.startswith('--') else (arg, '', '')
+        if option in ('-T', '--timestamps') and not equals:
+            ts = True
+            continue
+        if option not in ('-f', '--file', '-l', '--lang', '-e', '--engine'):
+            return None
+        if not equals:
+            value = next(args, '')
+            if not value or value.startswith('-') and value != '-':
+                return None
+        if option in ('-f', '--file'):
+            files.append(value)
+            option = None if equals else option
+        elif option in ('-l', '--lang'):
+            lang = value
+        elif value in ENGINES:
+            engine = value
+        else:
+            return None
+    if not files or '-' in files and len(files) > 1:
+        return None
+    return files, lang, ts, engine
+
 
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    file_args = _file_args(argv)
+    if file_args:
+        files, lang, ts, engine = file_args
+        for filepath in files:
+            DokuWiki2MarkDown.convert_file(filepath, lang, ts, engine)
+        return
 
-def main():
+    import argparse
     parser = argparse.ArgumentParser(description='Convert Dokuwiki to Markdown.')
     group = parser.add_mutually_exclusive_group(required=True)
-    group.add_argument('-f', '--file', help='File to convert.')
+    group.add_argument('-f', '--file', nargs='+', action='extend',
+                       help='Files to convert (- converts stdin to stdout).')
     group.add_argument('-d', '--directory', help='Directory of files to convert.')
+    group.add_argument('--serve', choices=FRAMINGS,
+                       help='Keep converting pages read from stdin (or --socket) until the end of input, each '
+                            'page NUL terminated or prefixed with its length in bytes and a newline.')
+    group.add_argument('--history', metavar='DATA_DIRECTORY',
+                       help='Write every revision of the pages of a DokuWiki data directory (from its attic, meta and '
+                            'pages directories) to stdout as a git fast-import stream.')
     parser.add_argument('-l', '--lang', help='Codeblocks will be labeled with this Language (eg. shell).')
     parser.add_argument('-T', '--timestamps', dest='timestamps', action='store_true',
                         help='Keep textual timestamps in documents. (Default is to remove timestamps)')
+    parser.add_argument('-e', '--engine', choices=ENGINES, default='regex',
+                        help='Conversion engine: the chain of regex transforms or the single pass tokenizer.')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Convert a directory using this many worker processes (0 = one per CPU).')
+    parser.add_argument('--io-concurrency', type=int, metavar='N',
+                        help='Convert a directory with the asyncio pipeline, overlapping up to N reads and writes '
+                             '(for network file systems).')
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help=f'Only convert pages changed since the last run, tracked in DIRECTORY/{MANIFEST_NAME}.')
+    parser.add_argument('--manifest', help='Manifest file to use for incremental runs (implies --incremental).')
+    parser.add_argument('--prune', action='store_true',
+                        help='With --incremental, delete .md files whose source page was removed.')
+    parser.add_argument('--profile', action='store_true',
+                        help='Time every conversion stage and report the slowest stages and pages.')
+    parser.add_argument('-s', '--stream', action='store_true',
+                        help='Read and convert pages piece by piece, to convert huge pages in bounded memory.')
+    parser.add_argument('--socket', help='With --serve, take connections on this Unix socket instead of stdin.')
+    parser.add_argument('-o', '--output',
+                        help='Write the converted directory to this directory (keeping namespaces) or archive '
+                             '(.tar, .tar.gz, .tar.bz2, .tar.xz or .zip) instead of next to the pages.')
+    parser.add_argument('--links', action='store_true',
+                        help='Resolve internal links against the pages of the directory, pointing them to the .md '
+                             'files and their section anchors, and report broken links.')
+    parser.add_argument('--media', metavar='MEDIA_DIRECTORY',
+                        help='DokuWiki media directory (eg. data/media) to resolve images against: the files used '
+                             'by the converted pages are exported next to them and missing ones are reported.')
+    parser.add_argument('--media-mode', choices=MEDIA_MODES, default='copy',
+                        help='Copy or hard link the exported media files.')
+    parser.add_argument('--cache', metavar='CACHE_DIRECTORY',
+                        help='Reuse the conversions of identical pages stored in this directory, and store new ones.')
+    parser.add_argument('--cache-size', type=int, default=CACHE_SIZE >> 20, metavar='MB',
+                        help='Size cap of the cache, least recently used conversions are removed beyond it.')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    if args.jobs < 0:
+        parser.error('--jobs must be 0 (one per CPU) or more')
+    if args.file and '-' in args.file and len(args.file) > 1:
+        parser.error('-f - can\'t be combined with other files')
+    if args.socket and not args.serve:
+        parser.error('--socket requires --serve')
+    if args.io_concurrency is not None and (args.incremental or args.manifest or args.profile or args.stream):
+        parser.error('--io-concurrency can\'t be combined with --incremental, --manifest, --profile or --stream')
+    if args.output and not args.directory:
+        parser.error('--output requires --directory')
+    if (args.links or args.media) and not args.directory:
+        parser.error('--links and --media require --directory')
+    if (args.links or args.media) and args.io_concurrency is not None:
+        parser.error('--links and --media can\'t be combined with --io-concurrency')
+    if DokuWiki2MarkDown._archive_mode(args.output) and (args.incremental or args.manifest or args.profile
+                                                          or args.stream or args.io_concurrency is not None):
+        parser.error('an archive --output can\'t be combined with --incremental, --manifest, --profile, --stream '
+                     'or --io-concurrency')
+    if args.history and (args.incremental or args.manifest or args.profile or args.stream
+                         or args.io_concurrency is not None):
+        parser.error('--history can\'t be combined with --incremental, --manifest, --profile, --stream or '
+                     '--io-concurrency')
+    if args.cache and (args.serve or args.history or args.file == ['-']):
+        parser.error('--cache requires a file or --directory')
+    if args.cache and (args.stream or args.links or args.media):
+        parser.error('--cache can\'t be combined with --stream, --links or --media')
     dw2md = DokuWiki2MarkDown()
+    if args.cache:
+        from doku2md_cache import ConversionCache
+    if args.profile:
+        from doku2md_profile import ConversionProfile
+    cache = ConversionCache(args.cache, args.cache_size << 20) if args.cache else None
+    profile = ConversionProfile() if args.profile else None
     if args.file:
-        dw2md.convert_file(args.file, args.lang, args.timestamps)
+        for filepath in args.file:
+            dw2md.convert_file(filepath, args.lang, args.timestamps, args.engine, profile=profile, stream=args.stream,
+                               cache=cache)
+        if cache:
+            cache.trim()
+    elif args.history:
+        dw2md.convert_history(args.history, args.lang, args.timestamps, args.engine,
+                              jobs=args.jobs or os.cpu_count() or 1)
     elif args.directory:
-        dw2md.convert_directory(args.directory, args.lang, args.timestamps)
+        jobs = args.jobs or os.cpu_count() or 1
+        manifest = args.manifest
+        if args.incremental and not manifest:
+            manifest = os.path.join(args.directory, MANIFEST_NAME)
+        if args.io_concurrency is not None:
+            import asyncio
+            asyncio.run(dw2md.convert_directory_async(args.directory, args.lang, args.timestamps, args.engine,
+                                                      concurrency=max(args.io_concurrency, 1), jobs=jobs,
+                                                      output=args.output, cache=cache))
+        else:
+            dw2md.convert_directory(args.directory, args.lang, args.timestamps, jobs, manifest=manifest,
+                                    prune=args.prune, engine=args.engine, profile=profile, stream=args.stream,
+                                    output=args.output, links=args.links, media=args.media,
+                                    media_mode=args.media_mode, cache=cache)
+    else:
+        # Stop a worker cleanly (removing its socket) when it is terminated
+        import signal
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        dw2md.serve(args.serve, args.lang, args.timestamps, args.engine, args.socket)
+    if profile:
+        # Keep stdout for the Markdown in filter mode
+        print(profile.report(), file=sys.stderr if args.file == ['-'] else sys.stdout)
 
 
 if __name__ == '__main__':
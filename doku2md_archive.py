@@ -0,0 +1,41 @@
+"""Archive output of doku2md (-d with an --output archive, see ARCHIVES): tar and zip writers.
+
+Imported by DokuWiki2MarkDown.convert_directory when it writes an archive.
+"""
+
+import time
+
+
+def open_archive(path, mode):
+    """Open an archive for writing, mode being one of the ARCHIVES modes."""
+    if mode == 'zip':
+        import zipfile
+        return zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+    import tarfile
+    return tarfile.open(path, mode)
+
+
+def add_to_archive(archive, mode, name, markdown_text):
+    """Add the Markdown of one page, as name, to an archive opened by open_archive."""
+    data = markdown_text.encode()
+    if mode == 'zip':
+        import zipfile
+        info = zipfile.ZipInfo(name, time.localtime()[:6])
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.external_attr = 0o644 << 16
+        archive.writestr(info, data)
+    else:
+        import tarfile
+        from io import BytesIO
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        info.mode = 0o644
+        archive.addfile(info, BytesIO(data))
+
+
+def add_file_to_archive(archive, mode, name, filepath):
+    if mode == 'zip':
+        archive.write(filepath, name)
+    else:
+        archive.add(filepath, name)
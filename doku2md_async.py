@@ -0,0 +1,121 @@
+"""asyncio pipeline of doku2md (--io-concurrency), for wiki trees on high latency file systems.
+
+Imported by DokuWiki2MarkDown.convert_directory_async and convert_pages_async when first used,
+so converting pages doesn't load asyncio.
+"""
+
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from doku2md import DokuWiki2MarkDown
+
+
+async def convert_directory_async(directory, lang, ts, engine='regex', concurrency=16, jobs=1, output=None,
+                                  cache=None):
+    """Convert every .txt page below directory with the asyncio pipeline of convert_pages_async.
+
+    Progress is reported as pages complete; like convert_directory, pages that fail to
+    convert don't stop the batch and are returned as a list of (filepath, error).
+    """
+    if not os.path.isdir(directory):
+        print(f"Error: Directory {directory} not found.")
+        return []
+
+    errors = []
+    converted = 0
+    async for filepath, result in convert_pages_async(directory, lang, ts, engine, concurrency, jobs, output, cache):
+        if isinstance(result, Exception):
+            errors.append((filepath, f'{type(result).__name__}: {result}'))
+        else:
+            print(f"Saving {result}")
+            converted += 1
+    if cache:
+        cache.trim()
+
+    for filepath, error in sorted(errors):
+        print(f"Error: {filepath}: {error}")
+    print(f"Converted {converted} of {converted + len(errors)} files ({len(errors)} errors)")
+    return errors
+
+
+async def convert_pages_async(directory, lang, ts, engine='regex', concurrency=16, jobs=1, output=None, cache=None):
+    """Convert every .txt page below directory, yielding (filepath, new filepath or exception) as they complete.
+
+    Directory scans, reads and writes run in a pool of concurrency threads, so that on a
+    high latency file system (eg. NFS) they overlap with each other and with conversions,
+    which run in jobs worker processes when jobs > 1. At most concurrency pages are in
+    flight at a time. output is an optional directory to mirror the converted tree into
+    (archives aren't supported), and cache an optional ConversionCache.
+    """
+    if DokuWiki2MarkDown._archive_mode(output):
+        raise ValueError('the asyncio pipeline can\'t write an archive output')
+    mirror = (directory, output) if output else None
+    loop = asyncio.get_running_loop()
+    io_pool = ThreadPoolExecutor(concurrency)
+    cpu_pool = ProcessPoolExecutor(jobs) if jobs > 1 else None
+    todo = asyncio.Queue(concurrency)
+    done = asyncio.Queue()
+
+    async def scan(path):
+        subdirs, pages = await loop.run_in_executor(io_pool, DokuWiki2MarkDown._scan_directory, path)
+        for filepath in pages:
+            await todo.put(filepath)
+        await asyncio.gather(*(scan(subdir) for subdir in subdirs))
+
+    async def convert(filepath):
+        dokuwiki_text = await loop.run_in_executor(io_pool, DokuWiki2MarkDown._read_page, filepath)
+        new_filepath = DokuWiki2MarkDown._md_path(filepath, mirror)
+        key = cache.key(dokuwiki_text, (lang, ts, engine)) if cache and dokuwiki_text else None
+        if key and await loop.run_in_executor(io_pool, cache.copy, key, new_filepath, bool(mirror)):
+            return new_filepath
+        markdown_text = ''
+        if dokuwiki_text:
+            markdown_text = await loop.run_in_executor(cpu_pool, DokuWiki2MarkDown._dokuwiki_to_markdown,
+                                                       dokuwiki_text, lang, ts, engine)
+        await loop.run_in_executor(io_pool, DokuWiki2MarkDown._write_page, new_filepath, markdown_text, bool(mirror))
+        if key:
+            await loop.run_in_executor(io_pool, cache.put, key, markdown_text)
+        return new_filepath
+
+    async def worker():
+        while True:
+            filepath = await todo.get()
+            if filepath is None:
+                return
+            try:
+                result = await convert(filepath)
+            except Exception as e:
+                result = e
+            await done.put((filepath, result))
+
+    async def run():
+        workers = [asyncio.ensure_future(worker()) for _ in range(concurrency)]
+        try:
+            await scan(directory)
+            for _ in workers:
+                await todo.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+            await done.put(None)
+
+    runner = asyncio.ensure_future(run())
+    try:
+        while True:
+            item = await done.get()
+            if item is None:
+                break
+            yield item
+        await runner  # raises if scanning failed
+    finally:
+        # When the caller stops early, wait for the pipeline to wind down before leaving
+        runner.cancel()
+        try:
+            await runner
+        except asyncio.CancelledError:
+            pass
+        io_pool.shutdown(wait=False, cancel_futures=True)
+        if cpu_pool:
+            cpu_pool.shutdown(wait=False, cancel_futures=True)
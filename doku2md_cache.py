@@ -0,0 +1,97 @@
+"""Conversion cache of doku2md (--cache).
+
+Imported on first use, see doku2md.ConversionCache.
+"""
+
+import os
+
+import doku2md
+
+
+class ConversionCache:
+    """On-disk cache of converted pages, keyed by a hash of the page, the conversion options and __version__.
+
+    Entries are plain Markdown files below directory, named after their key, so a hit costs
+    a file copy. They are written atomically (a temporary file renamed over the entry), so
+    any number of processes, on one machine or sharing the directory over the network, can
+    use the same cache. Using an entry updates its modification time; trim() removes the
+    least recently used entries until the cache fits in max_size bytes.
+    """
+
+    def __init__(self, directory, max_size=doku2md.CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+
+    @staticmethod
+    def key(dokuwiki_text, options):
+        import hashlib
+        import json
+        digest = hashlib.sha256(json.dumps([doku2md.__version__, *options]).encode())
+        digest.update(b'\0')
+        digest.update(dokuwiki_text.encode('utf-8', 'surrogatepass'))
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key[2:] + '.md')
+
+    def get(self, key):
+        """Return the Markdown cached under key, or None."""
+        try:
+            with open(self.path(key), 'r', encoding='utf-8') as f:
+                markdown_text = f.read()
+            os.utime(self.path(key))
+        except FileNotFoundError:  # never cached, or evicted meanwhile
+            return None
+        return markdown_text
+
+    def copy(self, key, filepath, makedirs=False):
+        """Copy the Markdown cached under key to filepath; return whether it was cached."""
+        import shutil
+
+        try:
+            doku2md.DokuWiki2MarkDown._replace_file(
+                filepath, lambda tmp_path: shutil.copyfile(self.path(key), tmp_path), makedirs)
+            os.utime(self.path(key))
+        except FileNotFoundError:
+            if os.path.exists(self.path(key)):
+                raise  # filepath can't be created
+            return False
+        return True
+
+    def put(self, key, markdown_text):
+        import tempfile
+
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.', suffix='.tmp')
+        try:
+            with open(fd, 'wb') as f:
+                f.write(markdown_text.encode('utf-8'))
+            os.chmod(tmp_path, 0o644)  # mkstemp only lets the owner read it
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def trim(self):
+        """Remove the least recently used entries until the cache fits in max_size bytes."""
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.directory):
+            for file in files:
+                # Temporary files belong to writes in progress
+                if file.endswith('.md') and not file.startswith('.'):
+                    try:
+                        stat = os.stat(os.path.join(root, file))
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, os.path.join(root, file)))
+                    total += stat.st_size
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -0,0 +1,144 @@
+"""History export of doku2md (--history): every revision of a DokuWiki wiki as a git fast-import stream.
+
+Imported by DokuWiki2MarkDown.convert_history when first used, so converting pages doesn't load it.
+"""
+
+import os
+import re
+import sys
+
+from doku2md import HISTORY_REF, DokuWiki2MarkDown
+
+_RE = {
+    # Old revisions in the attic: page.timestamp.txt, compressed or not
+    'attic_revision': re.compile(r'(.+)\.(\d+)\.txt(?:\.gz|\.bz2)?'),
+    'author_unsafe': re.compile(r'[<>\n]'),
+}
+
+# Commit messages of changelog entries without a summary, by entry type
+_CHANGE_TYPES = {'C': 'created', 'E': 'edited', 'e': 'minor edit', 'D': 'deleted', 'R': 'reverted'}
+
+
+def convert_history(data_directory, lang, ts, engine='regex', jobs=1, out=None, ref=HISTORY_REF):
+    """Write every revision of the pages of a DokuWiki data directory to out as a git fast-import stream.
+
+    Revisions are the old ones kept in data/attic (plain, gzip or bzip2 compressed) and the
+    current pages in data/pages. Each becomes a commit of its .md file on ref, in timestamp
+    order, with the author and summary of its data/meta changelog entry; pages deleted in
+    the wiki are deleted in git. Revisions are read, decompressed and converted in jobs
+    worker processes while a single stream is written to out (stdout by default), to pipe
+    into `git fast-import` in the target repository.
+
+    Progress and errors go to stderr. Revisions that can't be read or converted are
+    skipped and returned as a list of (filepath, error).
+    """
+    if not os.path.isdir(os.path.join(data_directory, 'pages')):
+        print(f"Error: {data_directory} is not a DokuWiki data directory (no pages directory).", file=sys.stderr)
+        return []
+
+    out = out or sys.stdout.buffer
+    changes = _read_changelogs(os.path.join(data_directory, 'meta'))
+    revisions = _find_revisions(data_directory, changes)
+    results = DokuWiki2MarkDown._map_pages([filepath for _, _, filepath in revisions if filepath], (lang, ts, engine),
+                                           jobs, _convert_revision)
+    errors = []
+    pages = set()
+    commits = 0
+    # Make git fast-import reject the stream if it is cut short
+    out.write(b'feature done\n')
+    for date, page_id, filepath in revisions:
+        path = page_id.replace(':', '/').encode() + b'.md'
+        if filepath:
+            _, result = next(results)
+            if isinstance(result, Exception):
+                errors.append((filepath, f'{type(result).__name__}: {result}'))
+                continue
+            change = b'M 644 inline %s\ndata %d\n%s\n' % (path, len(result), result)
+            pages.add(page_id)
+        elif page_id in pages:
+            change = b'D %s\n' % path
+            pages.discard(page_id)
+        else:
+            continue  # deleted before any revision we have
+        out.write(_history_commit(ref, date, page_id, changes.get((page_id, date))) + change)
+        commits += 1
+        if commits % 10000 == 0:
+            out.write(b'progress %d of %d revisions\n' % (commits, len(revisions)))
+    out.write(b'done\n')
+    out.flush()
+
+    for filepath, error in errors:
+        print(f"Error: {filepath}: {error}", file=sys.stderr)
+    print(f"Wrote {commits} of {len(revisions)} revisions of {len({page_id for _, page_id, _ in revisions})} pages "
+          f"({len(errors)} errors)", file=sys.stderr)
+    return errors
+
+
+def _read_changelogs(meta_directory):
+    """Return {(page id, timestamp): (ip, type, user, summary)} from the .changes files of the pages."""
+    changes = {}
+    for root, _, files in os.walk(meta_directory):
+        for file in files:
+            # _dokuwiki.changes repeats the changes of every page
+            if not file.endswith('.changes') or file.startswith('_'):
+                continue
+            with open(os.path.join(root, file), encoding='utf-8', errors='replace') as f:
+                for line in f:
+                    # date, ip, type, id, user, summary, extra, size change (older wikis have fewer)
+                    fields = line.rstrip('\n').split('\t')
+                    if len(fields) >= 4 and fields[0].isdigit():
+                        fields += [''] * (6 - len(fields))
+                        changes[fields[3], int(fields[0])] = (fields[1], fields[2], fields[4], fields[5])
+    return changes
+
+
+def _find_revisions(data_directory, changes):
+    """List (timestamp, page id, filepath) for every revision, by timestamp then page id.
+
+    filepath is None for deletions. The current revision of a page is its file in
+    data/pages, dated by its modification time as DokuWiki does; some wikis also keep
+    it in the attic, in which case it's only listed once.
+    """
+    revisions = {}
+    attic = os.path.join(data_directory, 'attic')
+    for root, _, files in os.walk(attic):
+        for file in files:
+            match = _RE['attic_revision'].fullmatch(file)
+            if match:
+                page_id = os.path.relpath(os.path.join(root, match.group(1)), attic).replace(os.sep, ':')
+                revisions[int(match.group(2)), page_id] = os.path.join(root, file)
+    pages = os.path.join(data_directory, 'pages')
+    for filepath in DokuWiki2MarkDown._find_pages(pages):
+        page_id = os.path.splitext(os.path.relpath(filepath, pages))[0].replace(os.sep, ':')
+        revisions.setdefault((int(os.stat(filepath).st_mtime), page_id), filepath)
+    for (page_id, date), (_, kind, _, _) in changes.items():
+        if kind == 'D':
+            revisions.setdefault((date, page_id), None)
+    return [(date, page_id, filepath) for (date, page_id), filepath in sorted(revisions.items())]
+
+
+def _convert_revision(filepath, lang, ts, engine='regex'):
+    """Convert a revision, compressed or not, to UTF-8 encoded Markdown."""
+    if filepath.endswith(('.gz', '.bz2')):
+        if filepath.endswith('.gz'):
+            import gzip as compression
+        else:
+            import bz2 as compression
+        with compression.open(filepath) as f:
+            dokuwiki_text = DokuWiki2MarkDown._decode_page(f.read())
+    else:
+        dokuwiki_text = DokuWiki2MarkDown._read_page(filepath)
+    if not dokuwiki_text:
+        return b''
+    return DokuWiki2MarkDown._dokuwiki_to_markdown(dokuwiki_text, lang, ts, engine).encode('utf-8')
+
+
+def _history_commit(ref, date, page_id, change):
+    """Return the fast-import commit header of a revision, change being its changelog entry or None."""
+    ip, kind, user, summary = change or ('', '', '', '')
+    author = _RE['author_unsafe'].sub('', user or ip).strip() or 'DokuWiki'
+    if not summary:
+        summary = _CHANGE_TYPES.get(kind, 'edited') if change else 'external edit'
+    message = f'{page_id}: {summary}\n'.encode()
+    return (f'commit {ref}\nauthor {author} <> {date} +0000\ncommitter {author} <> {date} +0000\n'.encode()
+            + b'data %d\n%s' % (len(message), message))
@@ -0,0 +1,217 @@
+"""Link and media indexes of doku2md (-d with --links or --media): the pages and media files of a wiki tree.
+
+Imported by DokuWiki2MarkDown.convert_directory when links or media are resolved.
+"""
+
+import os
+import posixpath
+import re
+
+from doku2md import DokuWiki2MarkDown
+
+_RE = {
+    'header_anchor': re.compile(r'^ *(={2,6}) *(.*?) *\1[ \t]*$', re.MULTILINE),
+    'header_markup': re.compile(r"__|//|''|</?del>"),
+    'id_separators': re.compile(r'(?:[^\w.-]|_)+'),
+    'anchor_punctuation': re.compile(r'[^\w\- ]'),
+}
+
+
+class LinkIndex:
+    """The pages of a wiki tree and the anchors of their sections, to resolve internal links against.
+
+    Pages are known by their DokuWiki id (eg. 'ns:sub:page'). Building the index reads every
+    page once, with up to jobs worker processes; resolving a link is then a few lookups.
+    """
+
+    def __init__(self, directory, filepaths=None, jobs=1):
+        self.directory = directory
+        if filepaths is None:
+            filepaths = DokuWiki2MarkDown._find_pages(directory)
+        self.pages = {}  # page id -> {DokuWiki section id: Markdown anchor}
+        for filepath, anchors in DokuWiki2MarkDown._map_pages(filepaths, (), jobs, LinkIndex._page_anchors):
+            # A page that can't be read still exists, its conversion reports the error
+            self.pages[self.page_id(filepath)] = {} if isinstance(anchors, Exception) else anchors
+
+    def page_id(self, filepath):
+        return os.path.splitext(os.path.relpath(filepath, self.directory))[0].replace(os.sep, ':')
+
+    def digest(self):
+        """Return a hash of the index, which changes whenever a link may resolve differently."""
+        import hashlib
+        import json
+        return hashlib.sha256(json.dumps(self.pages, sort_keys=True).encode()).hexdigest()
+
+    def resolve(self, page, target):
+        """Resolve a link target found on page to (page id, Markdown anchor or None, whether it exists).
+
+        As in DokuWiki, targets without a namespace or starting with '.' are relative to the
+        namespace of page, and '..' goes up one namespace. A target ending with ':' is a
+        namespace: it goes to its 'start' page, else to a page named after the namespace
+        inside or next to it.
+        """
+        target, _, section = target.strip().partition('#')
+        target = target.strip().replace('/', ':').replace(';', ':')
+        if not target:
+            resolved = page
+        else:
+            resolved = LinkIndex._absolute_id(page, target)
+            if target.endswith(':'):
+                name = resolved.rpartition(':')[2]
+                candidates = [f'{resolved}:start' if resolved else 'start']
+                if resolved:
+                    candidates += [f'{resolved}:{name}', resolved]
+                resolved = next((candidate for candidate in candidates if candidate in self.pages), candidates[0])
+
+        anchors = self.pages.get(resolved)
+        if not section:
+            return resolved, None, anchors is not None
+        anchor = anchors.get(LinkIndex._section_id(section)) if anchors else None
+        return resolved, anchor or LinkIndex._anchor(section), anchor is not None
+
+    def resolver(self, filepath, notes):
+        """Return the function turning the link targets of a page into Markdown link targets.
+
+        External, interwiki and email links are kept as they are. Internal links become the
+        path of the target's .md file relative to the page's, followed by the section anchor;
+        for those whose page or section doesn't exist ('broken link', target) is appended to
+        notes.
+        """
+        page = self.page_id(filepath)
+        folder = posixpath.dirname(page.replace(':', '/')) or '.'
+
+        def resolve(url):
+            if DokuWiki2MarkDown._RE['url_scheme'].match(url) or '>' in url or '@' in url:
+                return url
+            target, anchor, found = self.resolve(page, url)
+            if not found:
+                notes.append(('broken link', url.strip()))
+            if target == page and anchor:
+                return '#' + anchor
+            path = posixpath.relpath(target.replace(':', '/') + '.md', folder)
+            return f'{path}#{anchor}' if anchor else path
+        return resolve
+
+    @staticmethod
+    def _absolute_id(page, target):
+        """Return the id (of a page or media file) that target stands for on page, see resolve."""
+        target = target.strip().replace('/', ':').replace(';', ':')
+        if target.startswith('.') or ':' not in target:
+            target = page.rpartition(':')[0] + ':' + target
+        parts = []
+        for part in target.split(':'):
+            if part == '..':
+                if parts:
+                    parts.pop()
+            elif LinkIndex._clean_id(part):
+                parts.append(LinkIndex._clean_id(part))
+        return ':'.join(parts)
+
+    @staticmethod
+    def _page_anchors(filepath):
+        """Return {DokuWiki section id: Markdown anchor} for the headers of a page."""
+        text = DokuWiki2MarkDown._read_page(filepath)
+        if '==' not in text:
+            return {}
+        text = DokuWiki2MarkDown._RE['codeblock'].sub('\n', text)
+        anchors = {}
+        section_ids, markdown_anchors = set(), set()
+        for match in _RE['header_anchor'].finditer(text):
+            title = match.group(2)
+            section_id = LinkIndex._unique(LinkIndex._section_id(title), section_ids, '')
+            anchors[section_id] = LinkIndex._unique(LinkIndex._anchor(title), markdown_anchors, '-')
+        return anchors
+
+    @staticmethod
+    def _unique(name, seen, separator):
+        # Repeated titles are numbered: name1, name2... in DokuWiki, name-1, name-2... on GitHub
+        candidate = name
+        n = 0
+        while candidate in seen:
+            n += 1
+            candidate = f'{name}{separator}{n}'
+        seen.add(candidate)
+        return candidate
+
+    @staticmethod
+    def _clean_id(name):
+        """Clean one part of a page id as DokuWiki does: lowercase, other characters than letters,
+        digits, '.' and '-' turned into '_', and none of '._-' at either end."""
+        return _RE['id_separators'].sub('_', name.strip().lower()).strip('._-')
+
+    @staticmethod
+    def _section_id(title):
+        section_id = LinkIndex._clean_id(title).replace('.', '')
+        # Ids can't start with a digit
+        return section_id.lstrip('0123456789_-') or 'section' + ''.join(filter(str.isdigit, section_id))
+
+    @staticmethod
+    def _anchor(title):
+        """Return GitHub's anchor for the Markdown header of a DokuWiki title."""
+        title = _RE['header_markup'].sub('', title.strip().lower())
+        return _RE['anchor_punctuation'].sub('', title).replace(' ', '-')
+
+
+class MediaIndex:
+    """The files of a DokuWiki media directory (eg. data/media), to resolve and export the images of pages.
+
+    Media files are known by their id (eg. 'ns:image.png') and exported to the same place in
+    the converted tree, eg. next to the pages of the ns namespace for ns:image.png. pages is
+    the directory of the pages that use them.
+    """
+
+    def __init__(self, directory, pages):
+        self.directory = directory
+        self.pages = pages
+        self.files = {}  # media id -> path
+        for root, _, files in os.walk(directory):
+            for file in files:
+                filepath = os.path.join(root, file)
+                self.files[os.path.relpath(filepath, directory).replace(os.sep, ':')] = filepath
+
+    def resolver(self, filepath, notes):
+        """Return the function turning the internal image paths of a page into paths of exported files.
+
+        Paths are resolved as DokuWiki does (see LinkIndex.resolve) and made relative to the
+        page's .md file. ('media', id) is appended to notes for every image found in the
+        index, ('missing media', path) for the others.
+        """
+        page = os.path.splitext(os.path.relpath(filepath, self.pages))[0].replace(os.sep, ':')
+        folder = posixpath.dirname(page.replace(':', '/')) or '.'
+
+        def resolve(path):
+            media_id = LinkIndex._absolute_id(page, path)
+            notes.append(('media', media_id) if media_id in self.files else ('missing media', path.strip()))
+            return posixpath.relpath(media_id.replace(':', '/'), folder)
+        return resolve
+
+    def export(self, ids, destination, mode='copy'):
+        """Copy (or hard link, with mode 'link') the files of media ids below destination.
+
+        Files exported by a previous run are kept: the same file when linking, one with the
+        same size and modification time when copying. Files that can't be hard linked (eg.
+        on another file system) are copied.
+        """
+        import shutil
+
+        for media_id in sorted(ids):
+            source = self.files[media_id]
+            target = os.path.join(destination, *media_id.split(':'))
+            try:
+                exported = os.stat(target)
+            except FileNotFoundError:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+            else:
+                original = os.stat(source)
+                if os.path.samestat(exported, original) or (
+                        mode == 'copy' and (exported.st_size, exported.st_mtime_ns) == (original.st_size,
+                                                                                       original.st_mtime_ns)):
+                    continue
+                os.remove(target)
+            if mode == 'link':
+                try:
+                    os.link(source, target)
+                    continue
+                except OSError:
+                    pass
+            shutil.copy2(source, target)
@@ -0,0 +1,72 @@
+"""Conversion profiles of doku2md (--profile): the time every stage of the conversion takes.
+
+Imported when a conversion first reports its stages, or on first use of doku2md.ConversionProfile.
+"""
+
+import re
+
+from doku2md import DokuWiki2MarkDown
+
+_RE = DokuWiki2MarkDown._RE
+
+# What each stage looks for, to report match counts (see DokuWiki2MarkDown._run_stages)
+STAGE_MATCHES = {
+    '_rm_timestamp': _RE['timestamp'],
+    '_extract_codeblocks': _RE['codeblock'],
+    '_tr_links_initial_escape': _RE['link'],
+    '_tr_headers': re.compile(r'(={2,6}).*?\1 *\s'),
+    '_tr_italic': _RE['italic'],
+    '_tr_underline': _RE['underline'],
+    '_tr_monospaced': _RE['monospaced'],
+    '_tr_strikethrough': _RE['strikethrough'],
+    '_tr_images': _RE['image'],
+    '_tr_footnotes': _RE['footnote'],
+    '_tr_tables': re.compile(r'^\s*[\^|]', re.MULTILINE),
+    '_tr_lists': re.compile(r'^(?!----)\s*[-*]', re.MULTILINE),
+    '_tr_linebreaks': _RE['linebreak'],
+    '_tr_links_unescape': re.compile('##URL#ESCAPED#'),
+    '_rm_single_space_at_line_end': _RE['single_space_eol'],
+    '_rm_newlines': _RE['newlines'],
+    '_restore_codeblocks': re.compile('##CODEBLOCK#PLACEHOLDER#'),
+}
+
+
+class ConversionProfile:
+    """Aggregates the profile records of a conversion run.
+
+    Pass an instance as the profile of convert_file/convert_directory (any callable taking
+    (filepath, records) works) and print report() once the run is over.
+    """
+
+    def __init__(self):
+        self.stages = {}  # stage -> [calls, seconds, chars_in, chars_out, matches]
+        self.pages = []  # (seconds, filepath, chars_in, chars_out)
+
+    def __call__(self, filepath, records):
+        for stage, seconds, chars_in, chars_out, matches in records:
+            if stage == 'total':
+                self.pages.append((seconds, filepath, chars_in, chars_out))
+                continue
+            totals = self.stages.setdefault(stage, [0, 0.0, 0, 0, None])
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] += chars_in
+            totals[3] += chars_out
+            if matches is not None:
+                totals[4] = (totals[4] or 0) + matches
+
+    def report(self, top=10):
+        """Return the stages, slowest first, and the top slowest pages as text."""
+        total = sum(page[0] for page in self.pages)
+        lines = [f"Profile of {len(self.pages)} pages, {total * 1000:.1f} ms in total",
+                 '',
+                 f"{'stage':<30}{'calls':>7}{'ms':>10}{'share':>8}{'chars in':>12}{'chars out':>12}{'matches':>9}"]
+        for stage, (calls, seconds, chars_in, chars_out, matches) in sorted(
+                self.stages.items(), key=lambda item: item[1][1], reverse=True):
+            share = seconds / total if total else 0
+            lines.append(f"{stage:<30}{calls:>7}{seconds * 1000:>10.2f}{share:>8.1%}"
+                         f"{chars_in:>12}{chars_out:>12}{'-' if matches is None else matches:>9}")
+        lines += ['', f"{'ms':>10}{'chars in':>12}  slowest pages"]
+        for seconds, filepath, chars_in, _ in sorted(self.pages, reverse=True)[:top]:
+            lines.append(f"{seconds * 1000:>10.2f}{chars_in:>12}  {filepath}")
+        return '\n'.join(lines)
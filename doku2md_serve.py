@@ -0,0 +1,109 @@
+"""Worker mode of doku2md (--serve): pages converted as they are read from stdin or a Unix socket.
+
+Imported by DokuWiki2MarkDown.serve when first used, so converting pages doesn't load it.
+"""
+
+import os
+import sys
+
+from doku2md import DokuWiki2MarkDown
+
+
+def serve(framing, lang, ts, engine='regex', socket_path=None):
+    """Run as a long lived worker converting pages until the end of input.
+
+    Pages are read from stdin, or from every connection to a Unix socket created at
+    socket_path, as bytes that are either terminated by a NUL byte (framing 'nul') or
+    preceded by their length in bytes as a decimal number and a newline ('length'), and
+    decoded as page files are (see DokuWiki2MarkDown._decode_page). Each page is answered in
+    the same framing with its Markdown in UTF-8. A page that fails to convert is reported on
+    stderr and answered with an empty page; a length header that isn't a number, or a
+    truncated page, is reported and ends the input.
+    """
+    convert_args = (lang, ts, engine)
+    if socket_path is None:
+        _serve_stream(sys.stdin.buffer, sys.stdout.buffer, framing, convert_args)
+        return
+
+    server = _unix_server(socket_path, framing, convert_args)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+
+
+def _unix_server(socket_path, framing, convert_args):
+    """Return a server handling every connection to socket_path in its own thread."""
+    import socketserver
+    import stat
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            try:
+                _serve_stream(self.rfile, self.wfile, framing, convert_args)
+            except (OSError, ValueError) as e:
+                print(f"Error: connection dropped: {type(e).__name__}: {e}", file=sys.stderr)
+
+    # A socket left behind by a previous worker would make bind() fail
+    if os.path.exists(socket_path) and stat.S_ISSOCK(os.stat(socket_path).st_mode):
+        os.remove(socket_path)
+    server = socketserver.ThreadingUnixStreamServer(socket_path, Handler)
+    server.daemon_threads = True
+    return server
+
+
+def _serve_stream(rfile, wfile, framing, convert_args):
+    """Answer every page read from binary file rfile with its Markdown on wfile."""
+    for data in _read_frames(rfile, framing):
+        try:
+            text = DokuWiki2MarkDown._decode_page(data)  # as read from a file
+            markdown = DokuWiki2MarkDown._dokuwiki_to_markdown(text, *convert_args).encode()
+        except Exception as e:
+            print(f"Error: {type(e).__name__}: {e}", file=sys.stderr)
+            markdown = b''
+        if framing == 'length':
+            wfile.write(b'%d\n' % len(markdown) + markdown)
+        else:
+            wfile.write(markdown + b'\0')
+        wfile.flush()
+
+
+def _read_frames(rfile, framing):
+    """Yield the pages (bytes) read from rfile as soon as each is complete."""
+    if framing == 'length':
+        while True:
+            header = rfile.readline()
+            if not header.strip():
+                if not header:
+                    return
+                continue  # tolerate blank lines between pages
+            try:
+                size = int(header)
+            except ValueError:
+                size = -1
+            if size < 0:
+                # Where that page ends is unknown, so nothing after it can be read reliably
+                print(f'Error: bad page header {header[:64]!r}, stopped reading pages', file=sys.stderr)
+                return
+            data = rfile.read(size)
+            if len(data) < size:
+                print(f'Error: page truncated after {len(data)} of {size} bytes', file=sys.stderr)
+                return
+            yield data
+    else:
+        pending = []
+        # read1() returns whatever is available, so a page is answered without waiting for the next one
+        for block in iter(lambda: rfile.read1(1 << 16), b''):
+            if b'\0' not in block:
+                pending.append(block)
+                continue
+            pages = block.split(b'\0')
+            pending.append(pages[0])
+            yield b''.join(pending)
+            yield from pages[1:-1]
+            pending = [pages[-1]]
+        if any(pending):
+            yield b''.join(pending)  # last page without its NUL
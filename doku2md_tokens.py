@@ -0,0 +1,214 @@
+"""Token engine of doku2md (-e tokens), imported by DokuWiki2MarkDown._dokuwiki_to_markdown when first used.
+
+The page is split once into block tokens ('header', 'line') whose text is tokenized into
+inline tokens (str or ('link'|'image'|'em'|'u'|'tt'|'del'|'footnote', ...)), then everything
+is rendered in a single walk over the lines. Output matches the regex pipeline on well formed
+pages such as syntax.txt, but not on broken markup: unbalanced header markers ('==== d'),
+overlapping emphasis (//a __b// c__) and the like differ (see verify_doku2md.py -c tokens).
+"""
+
+import re
+
+from doku2md import DokuWiki2MarkDown
+
+# Emphasis content may contain whole links, but never stops inside one
+_INLINE_CONTENT = r'(?:(?=(?P<{0}>\[\[.*?\]\]))(?P={0})|(?!\[\[.*?\]\]).)*?'
+_INLINE_COMMON = (r"|''(?P<tt>.*?)''"
+                  r'|<del>(?P<del>.*?)</del>'
+                  r'|\{(?P<image>\{(?P<image_path>.*?)(?:\|(?P<image_alt>.*?))?\}\})'
+                  r'|\(\((?P<footnote>.*?)\)\)')
+
+_RE = {
+    # Named groups start after the first character so that the engine can skip ahead to it
+    'inline_token': re.compile(r'\[(?P<link>\[(?P<link_url>.*?)(?:\|(?P<link_title>.*?))?\]\])'
+                               r'|//(?P<em>' + _INLINE_CONTENT.format('em_link') + r')//'
+                               r'|__(?P<u>' + _INLINE_CONTENT.format('u_link') + r')__'
+                               + _INLINE_COMMON),
+    # Link titles keep their slashes and underscores, as the regex pipeline escapes them
+    'title_token': re.compile(_INLINE_COMMON[1:]),
+    'header_line': re.compile(r' *(={2,6}) *(.*?) *\1\s*$'),
+    'linebreak_eol': re.compile(r' *\\{2} *$'),
+}
+
+_INLINE_MARKUP = {'em': '*', 'u': '**', 'tt': '`', 'del': '~~'}
+
+
+def tokens_to_markdown(dokuwiki_text, codeblk_lang, timestamps, hook=None, footnotes=None, links=None, media=None,
+                       numbering=None):
+    stages = [] if timestamps else [('_rm_timestamp', DokuWiki2MarkDown._rm_timestamp)]
+    # The page is tokenized and rendered in one pass, so it is profiled as a single stage
+    stages.append(('_render_tokens',
+                   lambda text: _render_page(text, codeblk_lang, footnotes, links, media, numbering)))
+    text = DokuWiki2MarkDown._run_stages(stages, dokuwiki_text, hook).strip()
+    return text + '\n' if text else ''
+
+
+def _render_page(dokuwiki_text, codeblk_lang, footnotes=None, links=None, media=None, numbering=None):
+    blocks, codeblocks, marker = _tokenize(dokuwiki_text)
+    text = _render_tokens(blocks, footnotes, links, media, numbering)
+
+    # Put every code block back where its placeholder was left, even where the placeholder was
+    # copied (a link's title and URL) or dropped
+    if codeblocks:
+        lang_type = '' if codeblk_lang is None else codeblk_lang
+        pieces = text.split(marker)
+        pieces[1::2] = [f'\n\n```{lang_type}\n{codeblocks[int(index)]}\n```\n' for index in pieces[1::2]]
+        text = ''.join(pieces)
+    return text
+
+
+def _tokenize(text):
+    """Split a page into block tokens.
+
+    Code blocks are cut out first and replaced by a placeholder holding their index between
+    two marker characters, a character guaranteed not to occur in the page; returns
+    (blocks, codeblocks, marker).
+    """
+    marker = next(chr(c) for c in range(0xE000, 0xF900) if chr(c) not in text)
+    codeblocks = []
+
+    def extract(match):
+        codeblocks.append(match.group(1))
+        return f'{marker}{len(codeblocks) - 1}{marker}'
+
+    lines = DokuWiki2MarkDown._RE['codeblock'].sub(extract, text).split('\n')
+    blocks = []
+    i = 0
+    # Leading whitespace of the page is dropped (the regex pipeline strips the page before tables)
+    while i < len(lines) and (not lines[i] or lines[i].isspace()):
+        i += 1
+    if i < len(lines):
+        lines[i] = lines[i].lstrip()
+
+    while i < len(lines):
+        line = lines[i]
+        i += 1
+        header = None
+        if '==' in line:
+            # A code block right below a header ends up on the header line
+            head, code, tail = line.partition(marker)
+            header = _RE['header_line'].match(head)
+        # A header needs whitespace after it, be it the end of the line or trailing blanks
+        if header and (code or i < len(lines) or head[-1:].isspace()):
+            level, content = header.groups()
+            blocks.append(('header', 7 - len(level), _tokenize_inline(content),
+                           _tokenize_inline(code + tail) if code else None))
+            if code:
+                continue
+            # Headers swallow the blank lines and indentation following them
+            while i < len(lines) and (not lines[i] or lines[i].isspace()):
+                i += 1
+            if i < len(lines):
+                lines[i] = lines[i].lstrip()
+        else:
+            blocks.append(('line', _tokenize_inline(line)))
+    return blocks, codeblocks, marker
+
+
+def _tokenize_inline(text, title=False):
+    """Split a line into plain strings and inline markup tokens."""
+    pattern = _RE['title_token' if title else 'inline_token']
+    tokens = []
+    pos = 0
+    for match in pattern.finditer(text):
+        if match.start() > pos:
+            tokens.append(text[pos:match.start()])
+        pos = match.end()
+        kind = match.lastgroup
+        if kind == 'link':
+            url, title_text = match.group('link_url', 'link_title')
+            tokens.append(('link', url, _tokenize_inline(title_text or url, True)))
+        elif kind == 'image':
+            path, alt = match.group('image_path', 'image_alt')
+            tokens.append(('image', path, _tokenize_inline(alt, title) if alt else None))
+        else:
+            tokens.append((kind, _tokenize_inline(match.group(kind), title)))
+    if pos < len(text):
+        tokens.append(text[pos:])
+    return tokens
+
+
+def _render_inline(tokens, footnotes, links=None, media=None):
+    out = []
+    for token in tokens:
+        if token.__class__ is str:
+            out.append(token)
+            continue
+        kind = token[0]
+        if kind == 'link':
+            title = _render_inline(token[2], footnotes, links, media)
+            out.append(f'[{title}]({(links or DokuWiki2MarkDown._link_target)(token[1])})')
+        elif kind == 'image':
+            alt = _render_inline(token[2], footnotes, links, media) if token[2] else None
+            out.append(DokuWiki2MarkDown._image_markdown(token[1], alt, media))
+        elif kind == 'footnote':
+            footnotes[0] += 1
+            n = footnotes[0]
+            out.append(f'[^{n}]\n\n[^{n}]: {_render_inline(token[1], footnotes, links, media)}')
+        else:
+            markup = _INLINE_MARKUP[kind]
+            out.append(markup + _render_inline(token[1], footnotes, links, media) + markup)
+    return ''.join(out)
+
+
+def _render_tokens(blocks, footnotes=None, links=None, media=None, numbering=None):
+    """Render block tokens to Markdown (with code block markers) in one walk over the lines."""
+    if footnotes is None:
+        footnotes = [0]
+    physical_lines = []
+    for block in blocks:
+        if block[0] == 'header':
+            text = '#' * block[1] + ' ' + _render_inline(block[2], footnotes, links, media)
+            text += _render_inline(block[3], footnotes, links, media) if block[3] else '\n'
+        else:
+            text = _render_inline(block[1], footnotes, links, media)
+        # Footnotes introduce line breaks of their own
+        if '\n' in text:
+            physical_lines.extend(text.split('\n'))
+        else:
+            physical_lines.append(text)
+    # Trailing whitespace of the page is dropped before the line rules apply, as in the regex pipeline
+    while physical_lines and (not physical_lines[-1] or physical_lines[-1].isspace()):
+        physical_lines.pop()
+    if physical_lines:
+        physical_lines[-1] = physical_lines[-1].rstrip()
+    physical_lines.append('')  # flushes a table ending the page
+
+    out = []
+    blank = True  # Whitespace at the start of the page is stripped
+    ordered_list_counter = 0
+    table = []
+    last = len(physical_lines) - 2  # the flushing line aside
+    for i, line in enumerate(physical_lines):
+        if line.lstrip()[:1] in ('^', '|'):
+            table.append(line)
+            continue
+        if table:
+            rows = DokuWiki2MarkDown._render_table(table)
+            table = []
+            ordered_list_counter = 0
+        else:
+            rows = []
+        if numbering is not None and i == last:
+            numbering[0] = ordered_list_counter
+        line, ordered_list_counter = DokuWiki2MarkDown._list_item(line, ordered_list_counter)
+        if not i and numbering:
+            ordered_list_counter = numbering[0] or ordered_list_counter
+        rows.append(line)
+
+        for line in rows:
+            if '\\\\' in line:
+                line = _RE['linebreak_eol'].sub('  ', line)
+            if line.endswith(' ') and not line.endswith('  '):
+                line = line[:-1]
+            # Runs of blank lines collapse into one, eating the indentation of the next line
+            if not line or line.isspace():
+                blank = True
+                continue
+            if blank:
+                if out:
+                    out.append('')
+                line = line.lstrip()
+                blank = False
+            out.append(line)
+    return '\n'.join(out)
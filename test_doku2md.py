@@ -1,7 +1,22 @@
 #!/usr/bin/env python3
 
+import asyncio
+import bz2
+import gzip
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
 import unittest
-from doku2md import DokuWiki2MarkDown
+from contextlib import redirect_stderr, redirect_stdout
+from io import BufferedReader, BytesIO, StringIO, TextIOWrapper
+from unittest.mock import patch
+from doku2md import (ConversionCache, ConversionProfile, ConvertedPage, DokuWiki2MarkDown, LinkIndex, MediaIndex,
+                     _file_args, main)
+import doku2md_serve
 from textwrap import dedent
 
 
@@ -142,14 +157,75 @@ class TestDokuwikiToMarkdown(unittest.TestCase):
         | Row 3 Col 1    | Row 3 Col 2     | Row 3 Col 3        |
         """)
         md = dedent("""\
-        | Heading 1      | Heading 2       | Heading 3          |
-        |  --- | --- | --- |
-        | Row 1 Col 1    | Row 1 Col 2     | Row 1 Col 3        |
-        | Row 2 Col 1    | some colspan (note the double pipe) | |
-        | Row 3 Col 1    | Row 3 Col 2     | Row 3 Col 3        |
+        <table>
+        <tr><th align="left">Heading 1</th><th align="left">Heading 2</th><th align="left">Heading 3</th></tr>
+        <tr><td>Row 1 Col 1</td><td>Row 1 Col 2</td><td>Row 1 Col 3</td></tr>
+        <tr><td>Row 2 Col 1</td><td colspan="2">some colspan (note the double pipe)</td></tr>
+        <tr><td>Row 3 Col 1</td><td>Row 3 Col 2</td><td>Row 3 Col 3</td></tr>
+        </table>
         """)
         self.assertEqual(self.dtm._tr_tables(dw), md)
 
+    def test_gfm_tables(self):
+        dw = dedent("""\
+        |        ^ Heading 1 ^ Heading 2 ^
+        ^ Row 1  |  1 |  one |
+        ^ Row 2  | 22 |  two  |
+        ^ Row 3  | 333[^1] |
+        """)
+        md = dedent("""\
+        |        | Heading 1 | Heading 2 |
+        | --- | --- | --- |
+        | **Row 1**  |  1 |  one |
+        | **Row 2**  | 22 |  two  |
+        | **Row 3**  | 333[^1] | |
+        """)
+        self.assertEqual(md, self.dtm._tr_tables(dw))
+        # Tables without a header row get an empty one, columns are aligned like most of their cells
+        self.assertEqual('| | |\n| ---: | :---: |\n|  1|  a  |\n|  22|  bb  |\n| 333| c |\n',
+                         self.dtm._tr_tables('|  1|  a  |\n|  22|  bb  |\n| 333| c |'))
+
+    def test_not_tables(self):
+        # Lines without any cell are left as they are
+        for text in ('text\n|\nmore', 'text\n^\n |\nmore'):
+            self.assertEqual(text + '\n', self.dtm._tr_tables(text))
+            for engine in ('regex', 'tokens'):
+                self.assertEqual(text + '\n', DokuWiki2MarkDown._dokuwiki_to_markdown(text, None, False, engine))
+
+    def test_html_tables(self):
+        dw = dedent("""\
+        ^  Centered  ^^ Right ^
+        | a  | b | c |
+        | ::: |  d  ||
+        | ::: | e | f |
+        """)
+        md = dedent("""\
+        <table>
+        <tr><th colspan="2" align="center">Centered</th><th>Right</th></tr>
+        <tr><td rowspan="3">a</td><td>b</td><td>c</td></tr>
+        <tr><td colspan="2" align="center">d</td></tr>
+        <tr><td>e</td><td>f</td></tr>
+        </table>
+        """)
+        self.assertEqual(md, self.dtm._tr_tables(dw))
+
+    def test_html_table_cells(self):
+        # Markdown isn't rendered inside HTML cells: markup becomes HTML and the text is escaped
+        dw = dedent("""\
+        ^ [[ns:page|a_b **page**]] ^^
+        | x < y && ''<b>'' | [[https://example.com/a_b?c=1&d=2]] |
+        | {{wiki:logo.png|a "logo"}} | //it// <del>x</del> |
+        """)
+        md = dedent("""\
+        <table>
+        <tr><th colspan="2"><a href="ns/page">a_b <strong>page</strong></a></th></tr>
+        <tr><td>x &lt; y &amp;&amp; <code>&lt;b&gt;</code></td><td><a href="https://example.com/a_b?c=1&amp;d=2">https://example.com/a_b?c=1&amp;d=2</a></td></tr>
+        <tr><td><img src="wiki/logo.png" alt="a &quot;logo&quot;"></td><td><em>it</em> <del>x</del></td></tr>
+        </table>
+        """)
+        for engine in ('regex', 'tokens'):
+            self.assertEqual(md, DokuWiki2MarkDown._dokuwiki_to_markdown(dw, None, False, engine))
+
     def test_lists(self):
         self.assertEqual('* Unordered item', self.dtm._tr_lists('  * Unordered item'))
         self.assertEqual('1. Ordered item', self.dtm._tr_lists('  - Ordered item'))
@@ -174,5 +250,736 @@ class TestDokuwikiToMarkdown(unittest.TestCase):
         self.assertEqual('\nsometext\n\n', self.dtm._rm_newlines('\nsometext\n\n\n'))
 
 
+class TestTokenEngine(unittest.TestCase):
+    def convert(self, text, lang=None, ts=False):
+        return DokuWiki2MarkDown._dokuwiki_to_markdown(text, lang, ts, 'tokens')
+
+    def test_matches_regex_engine_on_syntax(self):
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'syntax.txt')) as f:
+            syntax = f.read()
+        for lang in (None, 'shell'):
+            for ts in (False, True):
+                self.assertEqual(DokuWiki2MarkDown._dokuwiki_to_markdown(syntax, lang, ts), self.convert(syntax, lang, ts))
+
+    def test_matches_regex_engine_on_snippets(self):
+        snippets = [
+            '[[https://example.com|Example]]', '[[some:namespaces]]', '[[https://example.com//two//slashes]]',
+            '====== Headline L1 ======\n \n \n text', '= Not A Headline =\n', '== No newline ==',
+            '<file>\ncode text</file>', '//italic//\n<code>\n//not italic//\n</code>\n//italic again//',
+            '{{wiki:dokuwiki-128.png|wiki:dokuwiki-128}} and {{https://secure.php.net/images/php.gif?200x50}}',
+            'First ((footnote //one//)) and second ((footnote two)).', 'Text on line\\\\   \nnext \n',
+            '  - First item 1\n  - First item 2\n\n  - Second item 1\n    * nested\n----',
+            '^ Heading 1 ^ Heading 2 ^\n| Row 1 Col 1 | colspan ||\n|  ::: | x |\n\ntext',
+            'Created Tuesday 03 April 2012\n//a [[http://x.com|x]] b// __u__ <del>d</del> \'\'m\'\'',
+        ]
+        for snippet in snippets:
+            self.assertEqual(DokuWiki2MarkDown._dokuwiki_to_markdown(snippet, None, False), self.convert(snippet), snippet)
+
+    def test_links_are_atomic(self):
+        self.assertEqual('*see [here](a/b)*\n', self.convert('//see [[a:b|here]]//'))
+        self.assertEqual('*a [http://x.com](http://x.com) b*\n', self.convert('//a [[http://x.com]] b//'))
+        self.assertEqual('[a__b__c](a__b__c)\n', self.convert('[[a__b__c]]'))
+
+    def test_code_inside_links_and_images(self):
+        # Code blocks are restored everywhere their placeholder was copied, and the text after them is kept
+        for text in ('see [[<code>q</code>]] and more\n\nnext para\n', 'an {{<code>q</code>|alt}} image\n\nnext\n',
+                     '[[a|<code>q</code>]] <code>r</code> [[<file>s</file>]]\nend\n'):
+            markdown = self.convert(text)
+            self.assertEqual(DokuWiki2MarkDown._dokuwiki_to_markdown(text, None, False), markdown, text)
+            self.assertTrue(markdown.endswith(('next para\n', 'next\n', 'end\n')), markdown)
+        self.assertEqual('see [\n\n```\nq\n```\n](\n\n```\nq\n```\n) and more\n\nnext para\n',
+                         self.convert('see [[<code>q</code>]] and more\n\nnext para\n'))
+
+    def test_header_before_code(self):
+        # The regex pipeline leaves this header unconverted
+        self.assertEqual('##### H\n\n```\nx\n```\n\nafter\n', self.convert('== H ==\n\n<code>\nx\n</code>\nafter'))
+
+
+class TestStreamConversion(unittest.TestCase):
+    def _stream(self, text, engine='regex', chunk_size=64):
+        out = StringIO()
+        DokuWiki2MarkDown._convert_stream(StringIO(text), out, 'sh', False, engine, chunk_size=chunk_size)
+        return out.getvalue()
+
+    def test_matches_whole_page(self):
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'syntax.txt')) as f:
+            syntax = f.read()
+        for engine in ('regex', 'tokens'):
+            expected = DokuWiki2MarkDown._dokuwiki_to_markdown(syntax, 'sh', False, engine)
+            for chunk_size in (1, 100, 4096, 1 << 20):
+                self.assertEqual(expected, self._stream(syntax, engine, chunk_size))
+
+    def test_footnotes_keep_counting(self):
+        text = 'One ((first))\n\nTwo ((second))\n\nThree ((third))\n'
+        self.assertEqual(DokuWiki2MarkDown._dokuwiki_to_markdown(text, 'sh', False), self._stream(text, chunk_size=1))
+        self.assertIn('[^3]: third', self._stream(text, 'tokens', 1))
+
+    def test_boundaries(self):
+        boundary = DokuWiki2MarkDown._stream_boundary
+        self.assertEqual((4, 7), boundary('foo\nbar\n'))
+        self.assertEqual((0, 3), boundary('foo\nbar'))  # the line after the cut must be complete
+        self.assertEqual((0, 21), boundary('foo\n  * item\n| cell |\n'))
+        self.assertEqual((0, 27), boundary('foo\nCreated Mon 01 Jan 2020\n'))
+        self.assertEqual((0, 0), boundary('<code>\nfoo\nbar\n'))  # unclosed code block
+        self.assertEqual((23, 26), boundary('foo\n<code>\nbar\n</code>\nbaz\nqux'))
+        # Blank lines end lists and tables, top level ones may start after them
+        self.assertEqual((13, 24), boundary('  * a\n  * b\n\n  - c\n| d |\n'))
+        self.assertEqual((0, 25), boundary('  * a\n\n    * nested\n  * b\n'))
+        self.assertEqual((7, 18), boundary('| a |\n\n| b |\n^ c ^\n'))
+        # Scanning resumes where it stopped, text before start isn't looked at again
+        self.assertEqual((0, 7), boundary('foo\nbar\n', 7))
+        self.assertEqual((8, 11), boundary('foo\nbar\nbaz\n', 7))
+
+    def test_long_list_is_cut(self):
+        # A page made of nothing but list items is written out before it has all been read
+        text = ''.join(f'  - item {n}\n  * bullet\n\n' for n in range(2000))
+        src = StringIO(text)
+        written_at = []
+
+        class Output(StringIO):
+            def write(self, data):
+                written_at.append(src.tell())
+                return super().write(data)
+
+        out = Output()
+        DokuWiki2MarkDown._convert_stream(src, out, None, False, chunk_size=1024)
+        self.assertEqual(DokuWiki2MarkDown._dokuwiki_to_markdown(text, None, False), out.getvalue())
+        self.assertGreater(len(written_at), 10)
+        self.assertLess(written_at[0], 2048)
+
+    def test_numbering_across_forced_cuts(self):
+        # A long ordered list without blank lines is cut anyway, its numbering goes on
+        text = ''.join(f'  - entry {n}\n' for n in range(2000))
+        for engine in ('regex', 'tokens'):
+            out = StringIO()
+            DokuWiki2MarkDown._convert_stream(StringIO(text), out, None, False, engine, chunk_size=1000, max_piece=4000)
+            self.assertEqual(DokuWiki2MarkDown._dokuwiki_to_markdown(text, None, False, engine), out.getvalue())
+            self.assertIn('\n2000. entry 1999\n', out.getvalue())
+
+    def test_uncut_stretches_are_capped(self):
+        # A code block that is never closed can't be cut, until it gets longer than max_piece
+        text = '<code>\n' + 'x\n' * 1000
+        out = StringIO()
+        with patch.object(out, 'write', wraps=out.write) as write:
+            DokuWiki2MarkDown._convert_stream(StringIO(text), out, None, False, chunk_size=100, max_piece=500)
+        self.assertGreater(write.call_count, 3)
+        self.assertTrue(all(len(call.args[0]) <= 600 for call in write.call_args_list))
+        self.assertEqual(DokuWiki2MarkDown._dokuwiki_to_markdown(text, None, False), out.getvalue())
+
+    def test_empty_page(self):
+        self.assertEqual('', self._stream(''))
+        self.assertEqual('', self._stream('\n\n  \n', chunk_size=1))
+
+
+class TestPipelines(unittest.TestCase):
+    pages = ['== Title ==\n//one// ((note))\n', '', '  * a\r\n  * b\r\n', 'caf\u00e9 <code>\nx\n</code>\n']
+
+    def test_filter(self):
+        # Pages on stdin are decoded like pages read from files, and written in UTF-8
+        page = self.pages[0] + 'caf\u00e9\r\n'
+        expected = DokuWiki2MarkDown._dokuwiki_to_markdown(page.replace('\r\n', '\n'), None, False).encode()
+        for data in (page.encode(), b'\xef\xbb\xbf' + page.encode(), page.encode('utf-16'), page.encode('latin-1')):
+            for stream in (False, True):
+                out = BytesIO()
+                with patch('sys.stdin', TextIOWrapper(BufferedReader(BytesIO(data)))), \
+                        patch('sys.stdout', TextIOWrapper(out, 'ascii')):
+                    DokuWiki2MarkDown.convert_file('-', None, False, stream=stream)
+                    self.assertEqual(expected, out.getvalue(), (data, stream))
+
+    def _expected(self):
+        return [DokuWiki2MarkDown._dokuwiki_to_markdown(page.replace('\r\n', '\n'), 'sh', False).encode()
+                for page in self.pages]
+
+    def test_serve_nul(self):
+        out = BytesIO()
+        requests = b''.join(page.encode() + b'\0' for page in self.pages)
+        doku2md_serve._serve_stream(BytesIO(requests), out, 'nul', ('sh', False))
+        self.assertEqual(self._expected(), out.getvalue().split(b'\0')[:-1])
+
+    def test_serve_encodings(self):
+        out = BytesIO()
+        page = 'caf\u00e9 //x//\r\n'
+        requests = b''.join(data + b'\0' for data in (page.encode('latin-1'), b'\xef\xbb\xbf' + page.encode()))
+        doku2md_serve._serve_stream(BytesIO(requests), out, 'nul', ('sh', False))
+        self.assertEqual([b'caf\xc3\xa9 *x*\n'] * 2, out.getvalue().split(b'\0')[:-1])
+
+    def test_serve_length(self):
+        out = BytesIO()
+        requests = b''.join(b'%d\n' % len(page.encode()) + page.encode() for page in self.pages)
+        doku2md_serve._serve_stream(BytesIO(requests), out, 'length', ('sh', False))
+        expected = b''.join(b'%d\n' % len(markdown) + markdown for markdown in self._expected())
+        self.assertEqual(expected, out.getvalue())
+
+    def test_serve_bad_length(self):
+        # Pages before a bad header are answered, then the worker stops reading instead of crashing
+        for bad in (b'abc\n', b'-1\n//a//\n', b'100\nshort'):
+            out = BytesIO()
+            requests = b'%d\n' % len(self.pages[0].encode()) + self.pages[0].encode() + bad + b'2\nok'
+            with redirect_stderr(StringIO()) as err:
+                doku2md_serve._serve_stream(BytesIO(requests), out, 'length', ('sh', False))
+            self.assertEqual(b'%d\n' % len(self._expected()[0]) + self._expected()[0], out.getvalue())
+            self.assertIn('Error: ', err.getvalue())
+
+    @unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'needs Unix sockets')
+    def test_unix_socket(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'doku2md.sock')
+            server = doku2md_serve._unix_server(path, 'length', ('sh', False))
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            try:
+                for _ in range(2):
+                    with socket.socket(socket.AF_UNIX) as client:
+                        client.connect(path)
+                        rfile = client.makefile('rb')
+                        for page, markdown in zip(self.pages, self._expected()):
+                            client.sendall(b'%d\n' % len(page.encode()) + page.encode())
+                            size = int(rfile.readline())
+                            self.assertEqual(markdown, rfile.read(size))
+            finally:
+                server.shutdown()
+                server.server_close()
+                thread.join()
+
+
+class TestCommandLine(unittest.TestCase):
+    def test_file_args(self):
+        self.assertEqual((['a.txt'], None, False, 'regex'), _file_args(['-f', 'a.txt']))
+        self.assertEqual((['a.txt', 'b.txt', 'c.txt'], 'sh', True, 'tokens'),
+                         _file_args(['-f', 'a.txt', 'b.txt', '-T', '--lang=sh', '--file', 'c.txt', '-e', 'tokens']))
+        self.assertEqual((['-'], None, False, 'regex'), _file_args(['--file', '-']))
+        # Left to argparse
+        for argv in ([], ['-d', 'pages'], ['-f', 'a.txt', '-j', '2'], ['-f', 'a.txt', '-e', 'none'], ['-f'],
+                     ['-f', '-', 'a.txt'], ['--file=a.txt', 'b.txt'], ['-l', 'sh', 'a.txt'], ['-Tf', 'a.txt'],
+                     ['-f', 'a.txt', '--time']):
+            self.assertIsNone(_file_args(argv), argv)
+
+    def test_negative_jobs(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for argv in (['-d', tmp, '-j', '-1'], ['--history', tmp, '--jobs=-2']):
+                with redirect_stderr(StringIO()) as err, self.assertRaises(SystemExit):
+                    main(argv)
+                self.assertIn('--jobs must be 0 (one per CPU) or more', err.getvalue())
+
+    def test_many_files(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = [os.path.join(tmp, f'page{n}.txt') for n in range(3)]
+            for n, path in enumerate(paths):
+                with open(path, 'w') as f:
+                    f.write(f'====== Page {n} ======\n//{n}//\n')
+            for argv in (['-f', *paths, '-l', 'sh'], ['-f', *paths, '-l', 'sh', '--cache', os.path.join(tmp, 'cache')]):
+                with redirect_stdout(StringIO()) as out:
+                    main(argv)
+                self.assertEqual([f'Saving {path[:-4]}.md' for path in paths], out.getvalue().splitlines())
+                for n, path in enumerate(paths):
+                    with open(path[:-4] + '.md') as f:
+                        self.assertEqual(f'# Page {n}\n\n*{n}*\n', f.read())
+                    os.remove(path[:-4] + '.md')
+
+
+class TestPageIO(unittest.TestCase):
+    page = '====== Caf\u00e9 ======\r\n//na\u00efve// ((note))\r\n'
+    encodings = {'utf8': page.encode(), 'bom': b'\xef\xbb\xbf' + page.encode(), 'utf16': page.encode('utf-16'),
+                 'utf32': page.encode('utf-32'), 'latin1': page.encode('latin-1')}
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        for name, data in self.encodings.items():
+            with open(os.path.join(self.tmp.name, name + '.txt'), 'wb') as f:
+                f.write(data)
+
+    def test_encodings(self):
+        expected = DokuWiki2MarkDown._dokuwiki_to_markdown(self.page.replace('\r\n', '\n'), None, False)
+        for mmap_size in (1 << 30, 1):
+            for stream in (False, True):
+                with patch('doku2md.MMAP_SIZE', mmap_size):
+                    self._convert(stream=stream)
+                for name in self.encodings:
+                    with open(os.path.join(self.tmp.name, name + '.md'), 'rb') as f:
+                        self.assertEqual(expected.encode(), f.read(), (name, mmap_size, stream))
+
+    def test_empty_page(self):
+        open(os.path.join(self.tmp.name, 'empty.txt'), 'w').close()
+        with patch.object(DokuWiki2MarkDown, '_dokuwiki_to_markdown') as convert:
+            page = DokuWiki2MarkDown._convert_path(os.path.join(self.tmp.name, 'empty.txt'), None, False)
+        convert.assert_not_called()
+        self.assertEqual(ConvertedPage(os.path.join(self.tmp.name, 'empty.md'), None, None), page)
+        self.assertEqual(0, os.path.getsize(page.path))
+        # Profiled or indexed, the page has the same shape
+        page = DokuWiki2MarkDown._convert_path(os.path.join(self.tmp.name, 'utf8.txt'), None, False, profile=True)
+        self.assertEqual('total', page.records[-1][0])
+        self.assertIsNone(page.notes)
+
+    def test_atomic_write(self):
+        self._convert()
+        with patch.object(DokuWiki2MarkDown, '_convert_stream', side_effect=MemoryError):
+            errors = self._convert(stream=True)
+        self.assertEqual(len(self.encodings), len(errors))
+        self.assertEqual(sorted(name + ext for name in self.encodings for ext in ('.txt', '.md')),
+                         sorted(os.listdir(self.tmp.name)))
+        with open(os.path.join(self.tmp.name, 'utf8.md')) as f:
+            self.assertIn('# Caf\u00e9', f.read())
+
+    def test_file_modes(self):
+        # New files get the umask's default mode, rewritten ones keep theirs
+        umask = os.umask(0o027)
+        self.addCleanup(os.umask, umask)
+        self._convert()
+        self.assertEqual(0o640, os.stat(os.path.join(self.tmp.name, 'utf8.md')).st_mode & 0o777)
+        os.chmod(os.path.join(self.tmp.name, 'utf8.md'), 0o604)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = ConversionCache(cache_dir)
+            for kwargs in ({}, {'stream': True}, {'cache': cache}, {'cache': cache}):  # the cache is filled, then copied
+                self._convert(**kwargs)
+                self.assertEqual(0o604, os.stat(os.path.join(self.tmp.name, 'utf8.md')).st_mode & 0o777, kwargs)
+
+    def _convert(self, **kwargs):
+        with redirect_stdout(StringIO()):
+            return DokuWiki2MarkDown.convert_directory(self.tmp.name, None, False, **kwargs)
+
+
+class TestConvertDirectory(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'syntax.txt')) as f:
+            syntax = f.read()
+        for ns in ('', 'ns1', os.path.join('ns1', 'sub'), 'ns2'):
+            os.makedirs(os.path.join(self.tmp.name, ns), exist_ok=True)
+            for name in ('start', 'syntax', 'other'):
+                with open(os.path.join(self.tmp.name, ns, name + '.txt'), 'w') as f:
+                    f.write(syntax if name == 'syntax' else f'====== {ns or "root"} {name} ======\n  * item //{name}//\n')
+
+    def _convert(self, jobs, **kwargs):
+        with redirect_stdout(StringIO()) as out:
+            errors = DokuWiki2MarkDown.convert_directory(self.tmp.name, None, False, jobs, **kwargs)
+        return errors, out.getvalue(), self._outputs()
+
+    def _outputs(self):
+        outputs = {}
+        for root, _, files in os.walk(self.tmp.name):
+            for file in files:
+                if file.endswith('.md'):
+                    with open(os.path.join(root, file), 'rb') as f:
+                        outputs[os.path.join(root, file)] = f.read()
+        return outputs
+
+    def test_parallel_matches_serial(self):
+        serial_errors, serial_log, serial = self._convert(1)
+        parallel_errors, parallel_log, parallel = self._convert(2)
+        self.assertEqual([], serial_errors)
+        self.assertEqual([], parallel_errors)
+        self.assertEqual(12, len(serial))
+        self.assertEqual(serial, parallel)
+        self.assertEqual(serial_log, parallel_log)
+
+    def test_async_matches_serial(self):
+        serial = self._convert(1)[2]
+        bad = os.path.join(self.tmp.name, 'ns1', 'bad.txt')
+        os.symlink(os.path.join(self.tmp.name, 'missing.txt'), bad)  # listed as a page, but can't be read
+        for jobs in (1, 2):
+            for path in serial:
+                os.remove(path)
+            with redirect_stdout(StringIO()) as out:
+                errors = asyncio.run(DokuWiki2MarkDown.convert_directory_async(self.tmp.name, None, False,
+                                                                               concurrency=3, jobs=jobs))
+            self.assertEqual([bad], [filepath for filepath, _ in errors])
+            self.assertIn('Converted 12 of 13 files (1 errors)', out.getvalue())
+            self.assertEqual(serial, self._outputs())
+
+    def test_async_rejects_archives(self):
+        output = os.path.join(self.tmp.name, 'out.zip')
+        with self.assertRaises(ValueError):
+            asyncio.run(DokuWiki2MarkDown.convert_directory_async(self.tmp.name, None, False, output=output))
+        self.assertFalse(os.path.exists(output))
+
+    def test_output_mirror(self):
+        in_place = {os.path.relpath(path, self.tmp.name): data for path, data in self._convert(1)[2].items()}
+        for path in in_place:
+            os.remove(os.path.join(self.tmp.name, path))
+        with tempfile.TemporaryDirectory() as out:
+            for jobs in (1, 2):
+                errors = self._convert(jobs, output=os.path.join(out, str(jobs)))[0]
+                self.assertEqual([], errors)
+                self.assertEqual({}, self._outputs())
+                mirrored = {}
+                for root, _, files in os.walk(os.path.join(out, str(jobs))):
+                    for file in files:
+                        with open(os.path.join(root, file), 'rb') as f:
+                            mirrored[os.path.relpath(os.path.join(root, file), os.path.join(out, str(jobs)))] = f.read()
+                self.assertEqual(in_place, mirrored)
+
+    def test_output_archive(self):
+        import tarfile
+        import zipfile
+
+        in_place = {os.path.relpath(path, self.tmp.name).replace(os.sep, '/'): data
+                    for path, data in self._convert(1)[2].items()}
+        for path in in_place:
+            os.remove(os.path.join(self.tmp.name, path))
+        with tempfile.TemporaryDirectory() as out:
+            for jobs, name in ((1, 'wiki.tar.gz'), (2, 'wiki.zip')):
+                archive = os.path.join(out, name)
+                errors, log, outputs = self._convert(jobs, output=archive)
+                self.assertEqual([], errors)
+                self.assertEqual({}, outputs)
+                self.assertIn(f'Saving {archive}:ns1/sub/syntax.md', log)
+                if name.endswith('.zip'):
+                    with zipfile.ZipFile(archive) as f:
+                        packed = {info.filename: f.read(info) for info in f.infolist()}
+                else:
+                    with tarfile.open(archive) as f:
+                        packed = {info.name: f.extractfile(info).read() for info in f.getmembers()}
+                self.assertEqual(in_place, packed)
+        with self.assertRaises(ValueError):
+            self._convert(1, output='wiki.tar', stream=True)
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = ConversionCache(cache_dir)
+            cold = self._convert(1, cache=cache)[2]
+            # The 4 copies of syntax.txt share one entry
+            self.assertEqual(9, sum(len(files) for _, _, files in os.walk(cache_dir)))
+            for path in cold:
+                os.remove(path)
+            with patch.object(DokuWiki2MarkDown, '_dokuwiki_to_markdown', side_effect=AssertionError):
+                self.assertEqual(cold, self._convert(1, cache=cache)[2])
+                self.assertEqual(cold, self._convert(2, cache=ConversionCache(cache_dir))[2])
+            # Other options don't hit the same entries
+            self.assertNotEqual(ConversionCache.key('page', (None, False, 'regex')),
+                                ConversionCache.key('page', ('bash', False, 'regex')))
+
+    def test_cache_trim(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = ConversionCache(cache_dir, max_size=250)
+            for n, key in enumerate(('aa01', 'bb02', 'cc03')):
+                cache.put(key, 'x' * 100)
+                os.utime(cache.path(key), (n, n))
+            self.assertEqual('x' * 100, cache.get('aa01'))  # now the most recently used
+            cache.trim()
+            self.assertEqual('x' * 100, cache.get('aa01'))
+            self.assertIsNone(cache.get('bb02'))
+            self.assertEqual('x' * 100, cache.get('cc03'))
+            self.assertFalse(cache.copy('bb02', os.path.join(cache_dir, 'page.md')))
+
+    def test_errors_are_collected(self):
+        bad = os.path.join(self.tmp.name, 'ns1', 'bad.txt')
+        os.symlink(os.path.join(self.tmp.name, 'missing.txt'), bad)  # listed as a page, but can't be read
+        for jobs in (1, 2):
+            errors, log, outputs = self._convert(jobs)
+            self.assertEqual([bad], [filepath for filepath, _ in errors])
+            self.assertIn('Converted 12 of 13 files (1 errors)', log)
+            self.assertEqual(12, len(outputs))
+
+    def test_incremental(self):
+        manifest = os.path.join(self.tmp.name, '.manifest.json')
+        _, log, first = self._convert(1, manifest=manifest)
+        self.assertIn('Converted 12 of 12 files (0 errors), 0 unchanged', log)
+
+        _, log, second = self._convert(1, manifest=manifest)
+        self.assertIn('Converted 0 of 12 files (0 errors), 12 unchanged', log)
+        self.assertEqual(first, second)
+
+        # Touched but identical pages are skipped on content hash, edited ones are converted
+        start = os.path.join(self.tmp.name, 'start.txt')
+        os.utime(start, ns=(0, 0))
+        with open(os.path.join(self.tmp.name, 'ns2', 'other.txt'), 'a') as f:
+            f.write('more //text//\n')
+        _, log, _ = self._convert(2, manifest=manifest)
+        self.assertIn('Converted 1 of 12 files (0 errors), 11 unchanged', log)
+
+        # Changing options invalidates everything
+        with redirect_stdout(StringIO()) as out:
+            DokuWiki2MarkDown.convert_directory(self.tmp.name, 'shell', False, manifest=manifest)
+        self.assertIn('Converted 12 of 12 files', out.getvalue())
+
+    def test_new_version_invalidates(self):
+        # A converter version whose output differs must not reuse what older versions produced
+        manifest = os.path.join(self.tmp.name, '.manifest.json')
+        with tempfile.TemporaryDirectory() as cache_dir:
+            with patch('doku2md.__version__', '1.0.0'):
+                self._convert(1, manifest=manifest)
+                self._convert(1, cache=ConversionCache(cache_dir))
+                old_key = ConversionCache.key('page', (None, False, 'regex'))
+            _, log, _ = self._convert(1, manifest=manifest)
+            self.assertIn('Converted 12 of 12 files (0 errors), 0 unchanged', log)
+            self.assertNotEqual(old_key, ConversionCache.key('page', (None, False, 'regex')))
+            with patch.object(DokuWiki2MarkDown, '_dokuwiki_to_markdown', return_value='new\n') as convert:
+                self._convert(1, cache=ConversionCache(cache_dir))
+                cached_calls = convert.call_count
+                with tempfile.TemporaryDirectory() as empty_dir:
+                    self._convert(1, cache=ConversionCache(empty_dir))
+            # Every page missed the cache, as with an empty one
+            self.assertEqual(cached_calls * 2, convert.call_count)
+
+    def test_incremental_orphans(self):
+        manifest = os.path.join(self.tmp.name, '.manifest.json')
+        self._convert(1, manifest=manifest)
+        os.remove(os.path.join(self.tmp.name, 'ns2', 'start.txt'))
+        orphan = os.path.join(self.tmp.name, 'ns2', 'start.md')
+
+        _, log, _ = self._convert(1, manifest=manifest)
+        self.assertIn(f'Orphan {orphan}', log)
+        self.assertTrue(os.path.exists(orphan))
+
+        _, log, _ = self._convert(1, manifest=manifest, prune=True)
+        self.assertIn(f'Removing orphan {orphan}', log)
+        self.assertFalse(os.path.exists(orphan))
+
+    def test_profile(self):
+        profile = ConversionProfile()
+        errors, _, outputs = self._convert(2, profile=profile)
+        self.assertEqual([], errors)
+        self.assertEqual(self._convert(1)[2], outputs)
+        pages = DokuWiki2MarkDown._find_pages(self.tmp.name)
+        self.assertEqual(sorted(pages), sorted(page[1] for page in profile.pages))
+        stages = ['_rm_timestamp', '_extract_codeblocks', *DokuWiki2MarkDown._TRANSFORMS, '_restore_codeblocks']
+        self.assertEqual(sorted(stages), sorted(profile.stages))
+        self.assertEqual(12, profile.stages['_tr_headers'][0])
+        self.assertIn('slowest pages', profile.report())
+
+    def test_profile_cache(self):
+        # Profiled runs fill and use the cache like other runs; pages copied from it only have a total
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = ConversionCache(cache_dir)
+            self._convert(1, profile=ConversionProfile(), cache=cache)
+            profile = ConversionProfile()
+            _, _, outputs = self._convert(1, profile=profile, cache=cache)
+        self.assertEqual(self._convert(1)[2], outputs)
+        self.assertEqual(12, len(profile.pages))
+        self.assertEqual({}, profile.stages)
+        self.assertEqual({None}, {chars_out for _, _, _, chars_out in profile.pages})
+
+    def test_stage_hook(self):
+        records = []
+        text = 'x //a// and //b//\n'
+        markdown = DokuWiki2MarkDown._dokuwiki_to_markdown(text, None, True, hook=lambda *r: records.append(r))
+        self.assertEqual(DokuWiki2MarkDown._dokuwiki_to_markdown(text, None, True), markdown)
+        self.assertNotIn('_rm_timestamp', [r[0] for r in records])
+        italic = next(r for r in records if r[0] == '_tr_italic')
+        self.assertEqual(2, italic[4])
+        self.assertEqual(italic[2] - 4, italic[3])
+
+
+class TestLinkIndex(unittest.TestCase):
+    PAGES = {
+        'start': '====== Home ======\nSee [[ns1:sub:page#Second Part|the page]], [[ns2:]] and [[missing]].\n',
+        'ns1/sub/page': '===== Part =====\n==== Second Part ====\n== Part ==\n'
+                        'Up [[..:..:start#home]], [[other]], [[.:other#nope]], [[#part]] and [[https://a.b/c_d]].\n',
+        'ns1/sub/other': '<code>\n== Not a header ==\n</code>\n',
+        'ns2/start': '[[..:start]]\n',
+    }
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        for page, text in self.PAGES.items():
+            os.makedirs(os.path.dirname(os.path.join(self.tmp.name, page)), exist_ok=True)
+            with open(os.path.join(self.tmp.name, page + '.txt'), 'w') as f:
+                f.write(text)
+
+    def test_index(self):
+        index = LinkIndex(self.tmp.name)
+        self.assertEqual({'start': {'home': 'home'},
+                          'ns1:sub:page': {'part': 'part', 'second_part': 'second-part', 'part1': 'part-1'},
+                          'ns1:sub:other': {},
+                          'ns2:start': {}}, index.pages)
+        page = 'ns1:sub:page'
+        self.assertEqual(('ns1:sub:other', None, True), index.resolve(page, 'other'))
+        self.assertEqual(('ns1:sub:other', None, True), index.resolve(page, '.:Other'))
+        self.assertEqual(('ns1:sub:other', None, True), index.resolve(page, ':ns1:sub:other'))
+        self.assertEqual(('start', 'home', True), index.resolve(page, '..:..:start#Home'))
+        self.assertEqual(('ns2:start', None, True), index.resolve(page, 'ns2:'))
+        self.assertEqual(('ns1:sub:page', 'second-part', True), index.resolve(page, '#Second Part'))
+        self.assertEqual(('ns1:sub:page', 'nope', False), index.resolve(page, '#nope'))
+        self.assertEqual(('ns1:missing', None, False), index.resolve(page, '..:missing'))
+
+    def test_convert_directory(self):
+        for engine in ('regex', 'tokens'):
+            for jobs in (1, 2):
+                with redirect_stdout(StringIO()) as out:
+                    errors = DokuWiki2MarkDown.convert_directory(self.tmp.name, None, False, jobs, engine=engine,
+                                                                 links=True)
+                self.assertEqual([], errors)
+                log = out.getvalue()
+                self.assertIn(f"Broken link: {os.path.join(self.tmp.name, 'start.txt')}: missing\n"
+                              f"Broken link: {os.path.join(self.tmp.name, 'ns1', 'sub', 'page.txt')}: .:other#nope\n"
+                              f"Converted 4 of 4 files (0 errors), 2 broken links", log)
+                with open(os.path.join(self.tmp.name, 'start.md')) as f:
+                    self.assertEqual('# Home\n\nSee [the page](ns1/sub/page.md#second-part), [ns2:](ns2/start.md) '
+                                     'and [missing](missing.md).\n', f.read())
+                with open(os.path.join(self.tmp.name, 'ns1', 'sub', 'page.md')) as f:
+                    self.assertIn('Up [..:..:start#home](../../start.md#home), [other](other.md), '
+                                  '[.:other#nope](other.md#nope), [#part](#part) and [https://a.b/c_d](https://a.b/c_d).',
+                                  f.read())
+
+
+class TestMediaIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.pages = os.path.join(self.tmp.name, 'pages')
+        self.media = os.path.join(self.tmp.name, 'media')
+        for path, data in (('pages/start.txt', '{{wiki:logo.png?200}} {{ns:photo.jpg|A "photo"}} {{:nope.png}}\n'),
+                           ('pages/ns/page.txt', '{{photo.jpg?0x50&nolink}} {{..:wiki:logo.png}}\n'),
+                           ('media/wiki/logo.png', 'logo'), ('media/ns/photo.jpg', 'photo'),
+                           ('media/unused.png', 'unused')):
+            os.makedirs(os.path.dirname(os.path.join(self.tmp.name, path)), exist_ok=True)
+            with open(os.path.join(self.tmp.name, path), 'w') as f:
+                f.write(data)
+
+    def test_media_markdown(self):
+        notes = []
+        media = MediaIndex(self.media, self.pages).resolver(os.path.join(self.pages, 'ns', 'page.txt'), notes)
+        for engine in ('regex', 'tokens'):
+            self.assertEqual('<img src="photo.jpg" alt="photo" height="50"> ![logo](../wiki/logo.png) '
+                             '![a](../a.png) ![php](https://secure.php.net/images/php.gif?200x50)\n',
+                             DokuWiki2MarkDown._dokuwiki_to_markdown(
+                                 '{{photo.jpg?0x50&nolink}} {{..:wiki:logo.png}} {{:a.png}} '
+                                 '{{https://secure.php.net/images/php.gif?200x50}}', None, False, engine, media=media))
+        self.assertEqual([('media', 'ns:photo.jpg'), ('media', 'wiki:logo.png'), ('missing media', ':a.png')] * 2,
+                         notes)
+        # Sized images are kept as they are in HTML tables
+        for engine in ('regex', 'tokens'):
+            self.assertEqual('<table>\n<tr><td colspan="2"><img src="photo.jpg" alt="photo" width="20"></td></tr>\n'
+                             '</table>\n',
+                             DokuWiki2MarkDown._dokuwiki_to_markdown('| {{photo.jpg?20}} ||\n', None, False, engine,
+                                                                     media=media))
+
+    def test_convert_directory(self):
+        import zipfile
+
+        for jobs, mode in ((1, 'copy'), (2, 'link')):
+            output = os.path.join(self.tmp.name, mode)
+            with redirect_stdout(StringIO()) as out:
+                DokuWiki2MarkDown.convert_directory(self.pages, None, False, jobs, output=output, media=self.media,
+                                                    media_mode=mode)
+            self.assertIn(f"Missing media: {os.path.join(self.pages, 'start.txt')}: :nope.png\n"
+                          "Converted 2 of 2 files (0 errors), 2 media files (1 missing)", out.getvalue())
+            with open(os.path.join(output, 'start.md')) as f:
+                self.assertEqual('<img src="wiki/logo.png" alt="logo" width="200"> '
+                                 '![A "photo"](ns/photo.jpg) ![nope](nope.png)\n', f.read())
+            exported = os.path.join(output, 'wiki', 'logo.png')
+            self.assertEqual(mode == 'link', os.path.samefile(exported, os.path.join(self.media, 'wiki', 'logo.png')))
+            self.assertEqual(['page.md', 'photo.jpg'], sorted(os.listdir(os.path.join(output, 'ns'))))
+            self.assertFalse(os.path.exists(os.path.join(output, 'unused.png')))
+
+        archive = os.path.join(self.tmp.name, 'wiki.zip')
+        with redirect_stdout(StringIO()):
+            DokuWiki2MarkDown.convert_directory(self.pages, None, False, output=archive, media=self.media)
+        with zipfile.ZipFile(archive) as f:
+            self.assertEqual(['start.md', 'ns/page.md', 'ns/photo.jpg', 'wiki/logo.png'], f.namelist())
+            self.assertEqual(b'logo', f.read('wiki/logo.png'))
+
+
+class TestHistory(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        files = {
+            'attic/start.1000.txt.gz': gzip.compress(b'====== Start ======\nfirst\n'),
+            'attic/start.2000.txt.bz2': bz2.compress('//second// caf\u00e9\n'.encode('latin-1')),
+            'pages/start.txt': b'**third**\n',
+            'attic/ns/old.1500.txt': b'old page\n',
+            'pages/ns/page.txt': b'  * item\n',
+            'meta/start.changes': b'1000\t10.0.0.1\tC\tstart\talice\tcreated\t\n'
+                                  b'2000\t10.0.0.2\tE\tstart\t\t\t\n3000\t10.0.0.1\te\tstart\tbob\ttypo\t\n',
+            'meta/ns/old.changes': b'1500\t10.0.0.1\tC\tns:old\talice\t\t\n1800\t10.0.0.1\tD\tns:old\tbob\tgone\t\n',
+            'meta/_dokuwiki.changes': b'1000\t10.0.0.1\tC\tstart\tmallory\tignored\t\n',
+        }
+        for name, data in files.items():
+            path = os.path.join(self.tmp.name, *name.split('/'))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(data)
+        os.utime(os.path.join(self.tmp.name, 'pages', 'start.txt'), (3000, 3000))
+        os.utime(os.path.join(self.tmp.name, 'pages', 'ns', 'page.txt'), (2500, 2500))
+
+    def _history(self, jobs=1):
+        out = BytesIO()
+        with redirect_stderr(StringIO()):
+            errors = DokuWiki2MarkDown.convert_history(self.tmp.name, None, False, jobs=jobs, out=out)
+        self.assertEqual([], errors)
+        return out.getvalue()
+
+    def test_stream(self):
+        stream = self._history()
+        self.assertEqual(stream, self._history(jobs=2))
+        commits = [commit.split(b'\n')[:4] for commit in stream.split(b'commit refs/heads/main\n')[1:]]
+        self.assertEqual([
+            [b'author alice <> 1000 +0000', b'committer alice <> 1000 +0000', b'data 15', b'start: created'],
+            [b'author alice <> 1500 +0000', b'committer alice <> 1500 +0000', b'data 16', b'ns:old: created'],
+            [b'author bob <> 1800 +0000', b'committer bob <> 1800 +0000', b'data 13', b'ns:old: gone'],
+            [b'author 10.0.0.2 <> 2000 +0000', b'committer 10.0.0.2 <> 2000 +0000', b'data 14', b'start: edited'],
+            [b'author DokuWiki <> 2500 +0000', b'committer DokuWiki <> 2500 +0000', b'data 23',
+             b'ns:page: external edit'],
+            [b'author bob <> 3000 +0000', b'committer bob <> 3000 +0000', b'data 12', b'start: typo'],
+        ], commits)
+        self.assertIn('M 644 inline start.md\ndata 15\n*second* caf\u00e9\n'.encode(), stream)
+        self.assertIn(b'\nD ns/old.md\n', stream)
+        self.assertTrue(stream.startswith(b'feature done\n') and stream.endswith(b'done\n'))
+
+    @unittest.skipUnless(shutil.which('git'), 'needs git')
+    def test_git_import(self):
+        repository = os.path.join(self.tmp.name, 'repository')
+        subprocess.run(['git', 'init', '-q', repository], check=True)
+        subprocess.run(['git', 'fast-import', '--quiet'], cwd=repository, input=self._history(), check=True)
+        log = subprocess.run(['git', 'log', '--format=%at %s', 'main'], cwd=repository, capture_output=True,
+                             text=True, check=True).stdout
+        self.assertEqual(['3000 start: typo', '2500 ns:page: external edit', '2000 start: edited', '1800 ns:old: gone',
+                          '1500 ns:old: created', '1000 start: created'], log.splitlines())
+        # The last commit holds the current pages
+        for page in ('start', 'ns/page'):
+            show = subprocess.run(['git', 'show', f'main:{page}.md'], cwd=repository, capture_output=True,
+                                  check=True).stdout
+            with open(os.path.join(self.tmp.name, 'pages', *page.split('/')) + '.txt') as f:
+                self.assertEqual(DokuWiki2MarkDown._dokuwiki_to_markdown(f.read(), None, False).encode(), show)
+
+
+class TestVerify(unittest.TestCase):
+    def test_candidates_agree(self):
+        from verify_doku2md import compare, converter, fuzz_corpus
+        documents = fuzz_corpus(5, 40)
+        reference = converter('regex', 'sh')
+        for mode in ('stream', 'parallel', 'cache'):
+            self.assertEqual([], compare(documents, reference, converter(mode, 'sh')), mode)
+
+    def test_difference(self):
+        from verify_doku2md import converter, difference
+        noise = '====== Title ======\n  * item //one//\n| a | b |\n'
+        text, diff = difference(noise + 'x //a __b// c__ y\n' + noise, converter('regex'), converter('tokens'))
+        self.assertLessEqual(len(text), len('//a __b// c__'))
+        self.assertIn('--- reference\n+++ candidate\n', diff)
+
+    def test_scaling(self):
+        from verify_doku2md import scaling
+        linear = lambda texts: time.sleep(len(texts[0]) * 2e-6)  # noqa: E731
+        quadratic = lambda texts: time.sleep(len(texts[0]) ** 2 * 1e-9)  # noqa: E731
+        self.assertLess(scaling(linear, {'a': 'ab'}, (1000, 2000, 4000))['a'], 1.5)
+        self.assertGreater(scaling(quadratic, {'a': 'ab'}, (1000, 2000, 4000))['a'], 1.5)
+
+
+class TestBenchCorpus(unittest.TestCase):
+    def test_generated_pages(self):
+        from bench_doku2md import PAGE_KINDS, generate_page
+        for kind in PAGE_KINDS:
+            page = generate_page(7, kind, 4096)
+            self.assertEqual(page, generate_page(7, kind, 4096))
+            self.assertNotEqual(page, generate_page(8, kind, 4096))
+            self.assertGreaterEqual(len(page), 4096)
+            for engine in ('regex', 'tokens'):
+                self.assertTrue(DokuWiki2MarkDown._dokuwiki_to_markdown(page, None, False, engine))
+
+    def test_generated_tree(self):
+        from bench_doku2md import generate_tree
+        with tempfile.TemporaryDirectory() as tmp:
+            count, size = generate_tree(tmp, 3, pages=30, depth=3, fanout=2)
+            found = DokuWiki2MarkDown._find_pages(tmp)
+            self.assertEqual(30, count)
+            self.assertEqual(30, len(found))
+            self.assertEqual(size, sum(os.path.getsize(path) for path in found))
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
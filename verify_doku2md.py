@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+
+import argparse
+import difflib
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from io import StringIO
+
+import doku2md
+from bench_doku2md import PAGE_KINDS, WORDS, generate_page, load_converter
+from doku2md import ConversionCache, DokuWiki2MarkDown
+
+# Conversions a reference and candidates can be: engines on whole pages, or the other code paths
+MODES = ('regex', 'tokens', 'stream', 'parallel', 'cache')
+
+# Characters per read in stream mode: small, so that pages are cut in many places
+STREAM_CHUNK = 64
+
+# Markup random documents are made of, opened and closed independently so that they end up
+# unbalanced, nested and overlapping
+FRAGMENTS = ('//', '__', "''", '**', '((', '))', '[[', ']]', '{{', '}}', '|', '^', ':::', '<del>', '</del>',
+             '<code>', '</code>', '<file bash>', '</file>', '\\\\ ', '==', '======', ':', '#', '?200', '?20x10',
+             'https://', '.png', ' ', '  ', '\t', '\\')
+LINE_STARTS = ('', '', '', '  * ', '  - ', '    * ', '| ', '^ ', '===== ', '> ', '<code>\n', '</code>\n', '  ',
+               'Created Mon 01 Jan 2024\n')
+
+# Unclosed markup repeated on one line, whose conversion time should grow linearly with the repetitions
+UNCLOSED = {'italic': '//a ', 'underline': '__a ', 'monospaced': "''a ", 'footnote': '((a ', 'link': '[[a ',
+            'image': '{{a ', 'strikethrough': '<del>a ', 'code': '<code>a ', 'table': '|a ', 'header': '== a '}
+
+
+# Documents -------------------------------------------------------------------
+
+def random_document(rng, size):
+    """Return a random DokuWiki document of about size characters, mostly made of broken markup."""
+    parts = []
+    length = 0
+    while length < size:
+        roll = rng.random()
+        if roll < 0.45:
+            part = rng.choice(WORDS)
+        elif roll < 0.55:
+            part = ' '
+        elif roll < 0.65:
+            part = '\n' + rng.choice(LINE_STARTS)
+        else:
+            part = rng.choice(FRAGMENTS)
+        parts.append(part)
+        length += len(part)
+    return ''.join(parts) + rng.choice(('', '\n'))
+
+
+def fuzz_corpus(seed, count, size=2048):
+    """Return count reproducible documents: random markup soup and, for one in four, a realistic page."""
+    rng = random.Random(seed)
+    documents = []
+    for n in range(count):
+        if n % 4 == 3:
+            documents.append((f'page-{n}', generate_page(f'{seed}:{n}', PAGE_KINDS[n // 4 % len(PAGE_KINDS)],
+                                                         rng.randint(1, size * 4))))
+        else:
+            documents.append((f'random-{n}', random_document(rng, rng.randint(0, size))))
+    return documents
+
+
+def load_corpus(directory):
+    """Return the (path, text) of every page below directory."""
+    return [(filepath, DokuWiki2MarkDown._read_page(filepath)) for filepath in DokuWiki2MarkDown._find_pages(directory)]
+
+
+# Conversions -----------------------------------------------------------------
+
+def converter(mode, lang=None, ts=False, engine='regex', jobs=2):
+    """Return a function converting a list of documents to their Markdown with mode.
+
+    mode is one of MODES or the path of another doku2md.py (eg. an older revision), whose
+    regex engine is used. stream, parallel and cache convert with engine; parallel and
+    cache write the documents to a temporary directory and run convert_directory on it,
+    with jobs worker processes or through a cache filled by a first run.
+    """
+    if mode in ('regex', 'tokens'):
+        return lambda texts: [DokuWiki2MarkDown._dokuwiki_to_markdown(text, lang, ts, mode) for text in texts]
+    if mode == 'stream':
+        return lambda texts: [_stream(text, lang, ts, engine) for text in texts]
+    if mode == 'parallel':
+        return lambda texts: _convert_directory(texts, lang, ts, engine, jobs=jobs)
+    if mode == 'cache':
+        return lambda texts: _convert_directory(texts, lang, ts, engine, cached=True)
+    baseline = load_converter(mode)
+    return lambda texts: [baseline._dokuwiki_to_markdown(text, lang, ts) for text in texts]
+
+
+def _stream(text, lang, ts, engine):
+    out = StringIO()
+    DokuWiki2MarkDown._convert_stream(StringIO(text), out, lang, ts, engine, chunk_size=STREAM_CHUNK)
+    return out.getvalue()
+
+
+def _convert_directory(texts, lang, ts, engine, jobs=1, cached=False):
+    with tempfile.TemporaryDirectory() as tmp:
+        pages = os.path.join(tmp, 'pages')
+        os.mkdir(pages)
+        paths = [os.path.join(pages, f'page{n}') for n in range(len(texts))]
+        for path, text in zip(paths, texts):
+            with open(path + '.txt', 'w', encoding='utf-8', newline='') as f:
+                f.write(text)
+        cache = ConversionCache(os.path.join(tmp, 'cache')) if cached else None
+        with redirect_stdout(StringIO()):
+            if cached:
+                # Only the second run reads its pages from the cache
+                DokuWiki2MarkDown.convert_directory(pages, lang, ts, jobs, engine=engine, cache=cache)
+                for path in paths:
+                    os.remove(path + '.md')
+            errors = DokuWiki2MarkDown.convert_directory(pages, lang, ts, jobs, engine=engine, cache=cache)
+        failed = {filepath for filepath, _ in errors}
+        outputs = []
+        for path in paths:
+            if path + '.txt' in failed:
+                outputs.append(None)
+                continue
+            with open(path + '.md', encoding='utf-8', newline='') as f:
+                outputs.append(f.read())
+        return outputs
+
+
+# Verification ----------------------------------------------------------------
+
+def compare(documents, reference, candidate):
+    """Return the indexes of the documents reference and candidate convert differently."""
+    texts = [text for _, text in documents]
+    return [n for n, (expected, actual) in enumerate(zip(reference(texts), candidate(texts))) if expected != actual]
+
+
+def minimize(text, failing):
+    """Return a shorter text for which failing(text) still holds.
+
+    Chunks of lines, then of characters, are removed as long as failing holds (the complement
+    half of delta debugging), halving the chunks when none can go.
+    """
+    for split in (lambda t: t.splitlines(keepends=True), list):
+        parts = split(text)
+        chunks = 2
+        while len(parts) > 1:
+            size = math.ceil(len(parts) / chunks)
+            for start in range(0, len(parts), size):
+                smaller = parts[:start] + parts[start + size:]
+                if failing(''.join(smaller)):
+                    parts = smaller
+                    chunks = max(chunks - 1, 2)
+                    break
+            else:
+                if size == 1:
+                    break
+                chunks = min(chunks * 2, len(parts))
+        text = ''.join(parts)
+    return text
+
+
+def difference(text, reference, candidate):
+    """Return (minimized text, unified diff of its reference and candidate conversions)."""
+    text = minimize(text, lambda t: reference([t]) != candidate([t]))
+    expected, actual = reference([text])[0], candidate([text])[0]
+    diff = difflib.unified_diff((expected or '').splitlines(keepends=True), (actual or '').splitlines(keepends=True),
+                                'reference', 'candidate')
+    return text, ''.join(diff)
+
+
+def slow_documents(documents, convert, factor=20, min_seconds=0.01):
+    """Return (name, seconds, size) of the documents convert takes more than factor times the median per character on."""
+    timings = []
+    for name, text in documents:
+        start = time.perf_counter()
+        convert([text])
+        timings.append((name, time.perf_counter() - start, len(text)))
+    rates = sorted(seconds / max(size, 1) for _, seconds, size in timings)
+    median = rates[len(rates) // 2] if rates else 0
+    return [(name, seconds, size) for name, seconds, size in timings
+            if seconds >= min_seconds and seconds / max(size, 1) > factor * median]
+
+
+def scaling(convert, patterns=None, repeats=(500, 1000, 2000)):
+    """Return {name: growth exponent} of the conversion time of each unclosed markup pattern.
+
+    The exponent is measured between the two largest repetitions: about 1 for linear time,
+    2 for quadratic backtracking.
+    """
+    exponents = {}
+    for name, pattern in (patterns or UNCLOSED).items():
+        seconds = []
+        for n in repeats:
+            text = pattern * n
+            best = math.inf
+            for _ in range(3):
+                start = time.perf_counter()
+                convert([text])
+                best = min(best, time.perf_counter() - start)
+            seconds.append(best)
+        exponents[name] = math.log(max(seconds[-1], 1e-9) / max(seconds[-2], 1e-9), repeats[-1] / repeats[-2])
+    return exponents
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that conversions of the Dokuwiki to Markdown converter agree.')
+    parser.add_argument('-r', '--reference', help=f'Reference conversion: one of {", ".join(MODES)} or another '
+                                                  'doku2md.py (Default is the --engine).')
+    parser.add_argument('-c', '--candidate', nargs='+', default=['stream', 'parallel', 'cache'],
+                        help='Conversions compared to the reference, same choices (Default is stream parallel cache).')
+    parser.add_argument('-d', '--directory', help='Check the pages of this directory instead of random documents.')
+    parser.add_argument('-n', '--documents', type=int, default=200, help='Number of random documents.')
+    parser.add_argument('--size', type=int, default=2048, help='Maximum size of the random documents.')
+    parser.add_argument('--seed', type=int, default=1, help='Seed of the random documents.')
+    parser.add_argument('-e', '--engine', choices=doku2md.ENGINES, default='regex',
+                        help='Engine of the stream, parallel and cache conversions.')
+    parser.add_argument('-l', '--lang', help='Codeblocks language, as for doku2md.py.')
+    parser.add_argument('-T', '--timestamps', action='store_true', help='Keep timestamps, as for doku2md.py.')
+    parser.add_argument('-j', '--jobs', type=int, default=2, help='Worker processes of the parallel conversion.')
+    parser.add_argument('--max-diffs', type=int, default=3, help='Minimized differences shown per candidate.')
+    parser.add_argument('--scaling', action='store_true',
+                        help='Also time the reference on growing runs of unclosed markup (//, \'\', ((...).')
+
+    args = parser.parse_args()
+    for mode in [args.reference or args.engine, *args.candidate]:
+        if mode not in MODES and not os.path.isfile(mode):
+            parser.error(f'unknown conversion {mode} (choose from {", ".join(MODES)} or a doku2md.py)')
+    options = (args.lang, args.timestamps, args.engine, max(args.jobs, 1))
+    reference = converter(args.reference or args.engine, *options)
+    documents = load_corpus(args.directory) if args.directory else fuzz_corpus(args.seed, args.documents, args.size)
+
+    failed = False
+    for mode in args.candidate:
+        candidate = converter(mode, *options)
+        differing = compare(documents, reference, candidate)
+        print(f'{mode}: {len(differing)} of {len(documents)} documents differ')
+        # Many documents tend to minimize to the same few inputs, only show distinct ones
+        shown = set()
+        for n in differing[:args.max_diffs * 10]:
+            name, text = documents[n]
+            text, diff = difference(text, reference, candidate)
+            if text not in shown:
+                shown.add(text)
+                print(f'\n{name}, minimized to {text!r}:\n{diff}')
+            if len(shown) == args.max_diffs:
+                break
+        failed = failed or bool(differing)
+
+    slow = slow_documents(documents, reference)
+    for name, seconds, size in slow:
+        print(f'Slow: {name}: {seconds * 1000:.1f} ms for {size} characters')
+    failed = failed or bool(slow)
+    if args.scaling:
+        for name, exponent in scaling(reference).items():
+            flag = '  superlinear' if exponent > 1.5 else ''
+            print(f'{name:<16}{UNCLOSED[name]!r:<12}time ~ n^{exponent:.1f}{flag}')
+            failed = failed or bool(flag)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()